@@ -0,0 +1,147 @@
+""" Measures parse time and peak memory of parse_year_data for each year
+using saved Wikipedia HTML fixtures.
+
+    python benchmark.py                      Benchmark every saved fixture
+    python benchmark.py --download           Save missing fixtures first
+    python benchmark.py --save base.json     Record results
+    python benchmark.py --compare base.json  Fail on regressions against
+                                             recorded results
+    python benchmark.py --verify             Also check output matches the
+                                             pd.read_html reference parser
+    python benchmark.py --parser read_html   Benchmark the reference parser """
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+import tracemalloc
+import urllib.request
+
+from releases import parse_year_data, read_html_year_data, first_year
+
+
+table_url = "http://en.wikipedia.org/wiki/{0}_in_video_games"
+user_agent = "wiki-game-releases-bot (https://github.com/BMatischen/wiki-game-releases-bot)"
+fixture_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'fixtures')
+parsers = {'stream': parse_year_data, 'read_html': read_html_year_data}
+
+
+def fixture_path(year):
+    return os.path.join(fixture_dir, f"{year}.html")
+
+
+""" Download article HTML for years that have no saved fixture """
+
+
+def download_fixtures(years):
+    os.makedirs(fixture_dir, exist_ok=True)
+    for year in years:
+        if os.path.exists(fixture_path(year)):
+            continue
+        request = urllib.request.Request(table_url.format(year),
+                                         headers={'User-Agent': user_agent})
+        with urllib.request.urlopen(request) as response:
+            html = response.read()
+        with open(fixture_path(year), 'wb') as f:
+            f.write(html)
+        print(f"Saved fixture for {year} ({len(html) / 1e6:.1f} MB)")
+
+
+""" Parse fixture for year repeatedly, returning best parse time, peak
+traced memory and number of releases found """
+
+
+def bench_year(year, repeat, parse):
+    with open(fixture_path(year), encoding='utf-8') as f:
+        html = f.read()
+
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        releases = parse(html, year)
+        times.append(time.perf_counter() - start)
+
+    # Measure memory in a separate run so tracing doesn't skew timings
+    tracemalloc.start()
+    parse(html, year)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'seconds': min(times), 'peak_mb': peak / 1e6, 'rows': len(releases)}
+
+
+""" Check parse_year_data gives the same releases as the read_html
+reference parser. Returns number of mismatched rows """
+
+
+def verify_year(year):
+    with open(fixture_path(year), encoding='utf-8') as f:
+        html = f.read()
+    releases = list(parse_year_data(html, year))
+    expected = list(read_html_year_data(html, year))
+    return sum(a != b for a, b in zip(releases, expected)) + abs(len(releases) - len(expected))
+
+
+def main():
+    curr_year = datetime.date.today().year
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('years', nargs='*', type=int,
+                        default=list(range(first_year, curr_year + 1)))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--download', action='store_true')
+    parser.add_argument('--save', metavar='FILE')
+    parser.add_argument('--compare', metavar='FILE')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Allowed relative slowdown before failing")
+    parser.add_argument('--parser', choices=parsers, default='stream')
+    parser.add_argument('--verify', action='store_true')
+    args = parser.parse_args()
+
+    if args.download:
+        download_fixtures(args.years)
+    years = [y for y in args.years if os.path.exists(fixture_path(y))]
+    if not years:
+        sys.exit("No fixtures found. Run with --download to save them.")
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    print(f"{'Year':<6}{'Rows':>7}{'Parse (ms)':>12}{'Peak (MB)':>11}")
+    for year in years:
+        result = results[str(year)] = bench_year(year, args.repeat,
+                                                 parsers[args.parser])
+        line = (f"{year:<6}{result['rows']:>7}"
+                f"{result['seconds'] * 1000:>12.1f}{result['peak_mb']:>11.1f}")
+
+        base = baseline.get(str(year))
+        if base is not None:
+            for key in ('seconds', 'peak_mb'):
+                if result[key] > base[key] * (1 + args.tolerance):
+                    regressions.append((year, key, base[key], result[key]))
+            line += f"  (was {base['seconds'] * 1000:.1f} ms, {base['peak_mb']:.1f} MB)"
+        if args.verify:
+            mismatches = verify_year(year)
+            if mismatches:
+                regressions.append((year, 'mismatched rows', 0, mismatches))
+            line += "  output differs" if mismatches else "  output matches"
+        print(line)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    for year, key, old, new in regressions:
+        print(f"Regression in {year}: {key} {old:.3f} -> {new:.3f}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,79 +1,920 @@
 import discord
 from discord.ext import commands, tasks
 import os
-import numpy as np
-import pandas as pd
+import re
 import datetime
 import time
 import traceback
 import motor.motor_asyncio
+import pymongo
+import socket
+import uuid
+import asyncio
+import heapq
+import zoneinfo
+import aiohttp
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from releases import (parse_year_data, save_year_data, load_year_data,
+                      ReleaseIndex, month_names, first_year,
+                      diff_releases, merge_changes, normalize_filters)
+from subscriptions import SubscriptionRepository
+from search import TitleIndex, tokenize
+import metrics
 
 
 prefix = '!'
-client = commands.Bot(command_prefix=prefix, help_command=None)
+if os.getenv('SHARD_COUNT'):
+    # Run a subset of shards in this process when SHARD_IDS is given,
+    # otherwise all of them
+    shard_ids = os.getenv('SHARD_IDS')
+    client = commands.AutoShardedBot(
+        command_prefix=prefix, help_command=None,
+        shard_count=int(os.getenv('SHARD_COUNT')),
+        shard_ids=[int(i) for i in shard_ids.split(',')] if shard_ids else None)
+else:
+    client = commands.Bot(command_prefix=prefix, help_command=None)
 table_url = "http://en.wikipedia.org/wiki/{0}_in_video_games"
+user_agent = "wiki-game-releases-bot (https://github.com/BMatischen/wiki-game-releases-bot)"
+revision_pattern = re.compile(r'"wgRevisionId":(\d+)')
+cache_ttl = 15 * 60  # Seconds before a cached year is revalidated
+cache_max_years = 24  # Enough to keep every supported year cached
+refresh_interval = 10 * 60  # Seconds between background refreshes, below cache_ttl
+warm_up_concurrency = 4
+fetch_timeout = 30  # Seconds allowed for downloading an article
+breaker_threshold = 3  # Failed fetches in a row before Wikipedia is left alone
+breaker_cooldown = 60  # Seconds before trying again, doubled while failures continue
+breaker_max_cooldown = 30 * 60
+stale_after = 30 * 60  # Seconds before responses say how old their data is
+parse_workers = 2  # Processes parsing and diffing articles
+store_dir = os.getenv('STORE_DIR', 'data')
+final_year_grace = datetime.timedelta(days=60)
+change_retention = datetime.timedelta(days=7)
+embed_limit = 4096  # Characters allowed in an embed description
+render_cache_size = 256
+page_size = 25  # Releases per page of a listing, keeping pages within embed_limit
+paged_messages = 500  # Recent paged listings that can still be turned
+search_limit = 100  # Most search results shown
+notify_retry_delay = datetime.timedelta(minutes=1)
+notify_slot = datetime.timedelta(minutes=1)  # Notifications falling due together are sent as one batch
+notify_concurrency = 20  # Notifications being sent at once
+notify_rate = 40  # Notifications sent per second, below the global limit of 50
+notify_attempts = 3
+notify_backoff = 2  # Seconds before first retry, doubled after each attempt
+instance_id = os.getenv('INSTANCE_ID') or f"{socket.gethostname()}-{os.getpid()}"
+lease_duration = datetime.timedelta(minutes=5)
+metrics_port = os.getenv('METRICS_PORT')  # Serve metrics on localhost if set
 cluster = motor.motor_asyncio.AsyncIOMotorClient(os.getenv('CLUSTER'))
 db_table = cluster[os.getenv('DATABASE')][os.getenv('TABLE')]
+subscriptions = SubscriptionRepository(db_table)
 
 c_error = discord.Colour.red()
 c_info = discord.Colour.blue()
 
 
-""" Reads wikipedia tables from article for chosen year and filters for
-tables for releases"""
+""" Metrics for the release data pipeline, commands and notifications.
+    Served in the Prometheus text format when metrics_port is set."""
+
+stage_seconds = metrics.Histogram(
+    'releases_stage_seconds',
+    "Time spent in each stage of getting and rendering release data")
+command_seconds = metrics.Histogram(
+    'bot_command_seconds', "Time taken to handle each command")
+notification_lag = metrics.Histogram(
+    'notification_lag_seconds',
+    "Time between a notification falling due and being sent",
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+notifications_sent = metrics.Counter(
+    'notifications_total', "Notifications attempted, by result")
+fanout_rate = metrics.Gauge(
+    'notification_fanout_per_second',
+    "Notifications sent per second in the last fan-out")
+cache_lookups = metrics.Counter(
+    'cache_lookups_total', "Lookups in the year and render caches, by result",
+    callback=lambda: {
+        (('cache', 'year'), ('result', 'hit')): year_cache.hits,
+        (('cache', 'year'), ('result', 'miss')): year_cache.misses,
+        (('cache', 'year'), ('result', 'coalesced')): year_cache.coalesced,
+        (('cache', 'render'), ('result', 'hit')): rendered.hits,
+        (('cache', 'render'), ('result', 'miss')): rendered.misses})
+cache_hit_rate = metrics.Gauge(
+    'cache_hit_ratio', "Share of cache lookups served without work",
+    callback=lambda: {
+        (('cache', 'year'),): year_cache.stats()['hit_rate'],
+        (('cache', 'render'),): rendered.hits / max(rendered.hits + rendered.misses, 1)})
+year_fetches = metrics.Counter(
+    'year_fetches_total', "Year fetches, by outcome",
+    callback=lambda: {(('outcome', k),): year_cache.stats()[k]
+                      for k in ('revalidated', 'refreshed', 'restored')})
+stale_served = metrics.Counter(
+    'stale_served_total', "Expired years served while revalidated in the background",
+    callback=lambda: year_cache.stale)
+breaker_open = metrics.Gauge(
+    'wikipedia_breaker_open', "Whether Wikipedia fetches are paused after failures",
+    callback=lambda: int(year_cache.breaker.blocked()))
+index_bytes = metrics.Gauge(
+    'release_index_bytes', "Memory used by the release index",
+    callback=lambda: year_cache.index.nbytes)
+
+
+""" Raised instead of fetching while Wikipedia is failing """
+
+
+class WikipediaUnavailable(Exception):
+
+    def __init__(self, retry_after):
+        super().__init__(f"Wikipedia unavailable, retrying in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+""" Circuit breaker for fetches. After threshold failures in a row no
+    fetches are made until a cooldown has passed, then a single trial
+    fetch is let through. The cooldown doubles each time the trial fails,
+    up to max_cooldown, and any success closes the breaker again."""
+
+
+class CircuitBreaker:
+
+    def __init__(self, threshold, cooldown, max_cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.delay = cooldown
+        self.failures = 0
+        self.open_until = 0
+        self.trial = False
+
+    def blocked(self):
+        return (self.failures >= self.threshold
+                and (time.monotonic() < self.open_until or self.trial))
+
+    def allow(self):
+        if self.blocked():
+            return False
+        if self.failures >= self.threshold:
+            self.trial = True
+        return True
+
+    def cancel(self):
+        # Let another trial through if this one was abandoned
+        self.trial = False
+
+    def success(self):
+        self.failures = 0
+        self.delay = self.cooldown
+        self.trial = False
+
+    def failure(self):
+        self.failures += 1
+        self.trial = False
+        if self.failures >= self.threshold:
+            self.open_until = time.monotonic() + self.delay
+            self.delay = min(self.delay * 2, self.max_cooldown)
+            print(f"Pausing Wikipedia fetches for {self.retry_after():.0f}s "
+                  f"after {self.failures} failures")
+
+    def retry_after(self):
+        return max(0.0, self.open_until - time.monotonic())
+
+
+""" Per-year cache of parsed release tables with TTL and LRU eviction.
+    Expired entries are revalidated with a conditional request, so an
+    unchanged article costs a 304 (or a matching revision id) and no
+    re-parse. Pages are fetched over a shared aiohttp session and parsed
+    in worker processes, as parsing is mostly pure Python that would hold
+    the GIL and stall the event loop in a thread. Workers send back the
+    compact release arrays, and concurrent lookups for the same year share
+    one in-flight fetch.
+    Parsed years are also saved to the on-disk store. After a restart,
+    finalized past years are served from disk without network access and
+    other years are served from disk while refreshed in the background.
+    Expired years are likewise served at once while revalidated in the
+    background, and fetches stop for a while after repeated failures so
+    a slow or failing Wikipedia does not hold up lookups."""
+
+
+class YearCache:
+
+    def __init__(self, ttl, max_years):
+        self.ttl = ttl
+        self.max_years = max_years
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.index = ReleaseIndex()
+        self.titles = TitleIndex()
+        self.session = None
+        self.pool = ThreadPoolExecutor(max_workers=parse_workers)
+        self.parse_pool = ProcessPoolExecutor(max_workers=parse_workers)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown,
+                                      breaker_max_cooldown)
+        self.hits = 0
+        self.stale = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.revalidated = 0
+        self.refreshed = 0
+        self.restored = 0
+        self.changes = deque()
+
+    async def get(self, year, force=False):
+        year = int(year)
+        entry = self.entries.get(year)
+        if entry is None and not force:
+            entry = self.restore(year)
+        now = time.monotonic()
+
+        if entry is not None and not force:
+            self.hits += 1
+            self.entries.move_to_end(year)
+            if not entry['final'] and now - entry['checked'] >= self.ttl:
+                self.revalidate(year, entry)
+            return entry['releases'], entry['url']
+
+        if entry is None:
+            self.misses += 1
+        return await asyncio.shield(self.start_load(year, entry))
+
+    def start_load(self, year, entry):
+        # Join the fetch already running for this year instead of
+        # starting another one
+        task = self.pending.get(year)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(self.load(year, entry))
+            self.pending[year] = task
+            task.add_done_callback(lambda t: self.pending.pop(year, None))
+        return task
+
+    def revalidate(self, year, entry):
+        # Refresh an expired year in the background unless a refresh is
+        # already running or fetches are paused
+        self.stale += 1
+        if year not in self.pending and not self.breaker.blocked():
+            self.start_load(year, entry).add_done_callback(log_task_error)
+
+    async def load(self, year, entry):
+        if entry is None:
+            entry = {'releases': None, 'url': table_url.format(year),
+                     'etag': None, 'modified': None, 'revision': None}
+        revision = entry['revision']
+        entry = await self.fetch(year, entry)
+        entry['checked'] = time.monotonic()
+        entry['final'] = is_final_year(year)
+
+        if entry['revision'] != revision or entry['revision'] is None:
+            loop = asyncio.get_running_loop()
+            with stage_seconds.time(stage='save'):
+                await loop.run_in_executor(
+                    self.pool, save_year_data, store_path(year), entry['releases'],
+                    {k: entry[k] for k in ('url', 'etag', 'modified', 'revision',
+                                           'verified')})
+        self.remember(year, entry)
+        return entry['releases'], entry['url']
+
+    def restore(self, year):
+        # Load year saved by a previous run. Years that may still change
+        # are served while a refresh runs in the background
+        path = store_path(year)
+        if not os.path.exists(path):
+            return None
+        try:
+            releases, meta = load_year_data(path)
+        except Exception as e:
+            print(traceback.format_exc())
+            return None
+
+        entry = dict(meta, releases=releases, checked=time.monotonic(),
+                     final=is_final_year(year))
+        self.restored += 1
+        self.remember(year, entry)
+        if not entry['final']:
+            self.start_load(year, entry).add_done_callback(log_task_error)
+        return entry
+
+    def remember(self, year, entry):
+        old = self.entries.get(year)
+        if old is None or old['releases'] is not entry['releases']:
+            self.index.set_year(year, entry['releases'])
+            self.titles.set_year(year, entry['releases'])
+        self.entries[year] = entry
+        self.entries.move_to_end(year)
+        while len(self.entries) > self.max_years:
+            old_year, old = self.entries.popitem(last=False)
+            self.index.drop_year(old_year)
+            self.titles.drop_year(old_year)
+
+    async def fetch(self, year, entry):
+        # Send validators from the last fetch so Wikipedia can answer 304
+        headers = {'User-Agent': user_agent}
+        if entry['releases'] is not None:
+            if entry['etag'] is not None:
+                headers['If-None-Match'] = entry['etag']
+            if entry['modified'] is not None:
+                headers['If-Modified-Since'] = entry['modified']
+
+        if not self.breaker.allow():
+            raise WikipediaUnavailable(self.breaker.retry_after())
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=fetch_timeout))
+        try:
+            with stage_seconds.time(stage='fetch'):
+                async with self.session.get(entry['url'], headers=headers) as response:
+                    if response.status == 304 and entry['releases'] is not None:
+                        self.breaker.success()
+                        self.revalidated += 1
+                        return dict(entry, verified=time.time())
+                    response.raise_for_status()
+                    html = await response.text()
+                    etag = response.headers.get('ETag')
+                    modified = response.headers.get('Last-Modified')
+        except aiohttp.ClientResponseError as e:
+            # Missing articles are not an outage, unlike rate limits and
+            # server errors
+            if e.status == 429 or e.status >= 500:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.breaker.failure()
+            raise
+        except asyncio.CancelledError:
+            self.breaker.cancel()
+            raise
+        except Exception:
+            # Any other error, e.g. an undecodable response, still counts
+            # so a trial fetch always resolves the breaker
+            self.breaker.failure()
+            raise
+        self.breaker.success()
+
+        # Skip re-parsing if the article revision has not changed
+        match = revision_pattern.search(html)
+        revision = int(match.group(1)) if match is not None else None
+        if (entry['releases'] is not None and revision is not None
+                and revision == entry['revision']):
+            self.revalidated += 1
+        else:
+            self.refreshed += 1
+            with stage_seconds.time(stage='parse'):
+                releases = await self.run_parser(parse_year_data, html, year)
+            if entry['releases'] is not None:
+                with stage_seconds.time(stage='diff'):
+                    changes = await self.run_parser(
+                        diff_releases, entry['releases'], releases)
+                self.record_changes(year, changes)
+            entry = dict(entry, releases=releases, revision=revision)
+        return dict(entry, etag=etag, modified=modified, verified=time.time())
 
+    async def run_parser(self, func, *args):
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.parse_pool, func, *args)
+        except BrokenProcessPool:
+            # A worker died, so later parses need a new pool
+            self.parse_pool = ProcessPoolExecutor(max_workers=parse_workers)
+            raise
 
-def get_year_data(year):
-    df = None
-    url = None
-    try:
-        url = table_url.format(str(year))
-        tables = pd.read_html(url, match='Title')
-        months = []
-        headings = ['Month', 'Day', 'Title']
-
-        # Keep tables with first 3 columns of release tables as expected
-        for frame in tables:
-            curr_headings = list(frame.columns[:3])
-            if curr_headings == headings:
-                months.append(frame)
-
-        # Merge kept tables. Replace TBA dates with NaN to remove later
-        df = (pd.concat(months)[['Month', 'Day', 'Title']]
-              .replace('TBA', np.NaN))
-
-        # Remove rows with inappropriate month data
-        months = ["January", "February", "March",
-                  "April", "May", "June",
-                  "July", "August", "September",
-                  "October", "November", "December"]
-        df['Month'] = df['Month'].apply(lambda x: x.title())
-        df = df[df['Month'].isin(months)].dropna()
-
-        df['Title'] = df['Title'].replace(r"\[.*\]", "", regex=True)
-
-        # Add and clean columns for date data
-        # Then make string column for dates and convert column to datetime
-        df['Year'] = pd.Series([year] * len(df['Month']))
-        df['Day'] = df['Day'].astype(int)
-        df['Date'] = df[['Year', 'Month', 'Day']].apply(
-            lambda x: '-'.join(x.values.astype(str)), axis='columns')
-        df['Date'] = pd.to_datetime(df['Date'])
-
-        df.sort_values(by='Date', inplace=True)
-        df.drop(['Year', 'Day', 'Month'], axis='columns', inplace=True)
+    def record_changes(self, year, changes):
+        now = datetime.datetime.utcnow()
+        if changes:
+            self.changes.append((now, year, changes))
+            print(f"Detected {len(changes)} release changes for {year}")
+        while self.changes and now - self.changes[0][0] > change_retention:
+            self.changes.popleft()
 
-    except Exception as e:
-        raise e
-    return df, url
+    """ Releases added, removed or re-dated since the given date, as one
+    change set """
+
+    def changes_since(self, since):
+        return merge_changes([changes for detected, year, changes
+                              in self.changes if detected >= since])
+
+    """ Seconds since a year's data was last confirmed up to date, or None
+    if the year is finalized or has never been fetched """
+
+    def age(self, year):
+        entry = self.entries.get(int(year))
+        if entry is None or entry['final'] or entry.get('verified') is None:
+            return None
+        return time.time() - entry['verified']
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'years': sorted(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'stale': self.stale,
+                'breaker_open': self.breaker.blocked(),
+                'coalesced': self.coalesced,
+                'revalidated': self.revalidated,
+                'refreshed': self.refreshed,
+                'restored': self.restored,
+                'memory': self.index.nbytes}
+
+
+year_cache = YearCache(ttl=cache_ttl, max_years=cache_max_years)
+release_index = year_cache.index
+title_index = year_cache.titles
+
+
+def store_path(year):
+    return os.path.join(store_dir, f"{year}.npz")
+
+
+""" Check if year ended long enough ago that its article is no longer
+expected to change """
+
+
+def is_final_year(year):
+    year_end = datetime.datetime(int(year), 12, 31)
+    return datetime.datetime.utcnow() - year_end > final_year_grace
+
+
+def log_task_error(task):
+    if not task.cancelled() and task.exception() is not None:
+        e = task.exception()
+        print(''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+
+
+""" Gets release data for chosen year, served from the year cache where
+possible"""
+
+
+async def get_year_data(year, force=False):
+    return await year_cache.get(year, force)
+
+
+""" Note saying how out of date the data for years may be, or None if it
+was confirmed recently """
+
+
+def staleness_note(years):
+    ages = [age for age in map(year_cache.age, years) if age is not None]
+    if not ages or max(ages) < stale_after:
+        return None
+    note = f"Release data last updated {format_age(max(ages))} ago"
+    if year_cache.breaker.blocked():
+        note += " - Wikipedia is unavailable"
+    return note
+
+
+def format_age(seconds):
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return f"{minutes} minutes"
+    if minutes < 48 * 60:
+        return f"{minutes // 60} hours"
+    return f"{minutes // (24 * 60)} days"
+
+
+""" Cache of rendered release lists, keyed by the list and its dates.
+    A list is built once and then reused until the data for any year it
+    covers changes."""
+
+
+class RenderCache:
+
+    def __init__(self, index, max_entries):
+        self.index = index
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, years, render, *args):
+        versions = tuple(self.index.versions.get(y) for y in sorted(years))
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == versions:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+
+        self.misses += 1
+        with stage_seconds.time(stage='render'):
+            msg = render(*args)
+        self.entries[key] = (versions, msg)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return msg
+
+
+rendered = RenderCache(release_index, max_entries=render_cache_size)
+
+
+def page_count(rows):
+    return max(1, -(-rows // page_size))
+
+
+""" Render a page of releases for a month of a year matching filters,
+ordered by date. Returns the page and the number of pages """
+
+
+def render_month(year, month, filters, page):
+    releases = release_index.month(year, month, filters)
+    start = page * page_size
+    rows = [f"{date.strftime('%d')}  {title}\n"
+            for date, title in releases[start:start + page_size]]
+    return (f"{len(releases)} games released this month\n\n" + ''.join(rows),
+            page_count(len(releases)))
+
+
+""" Render a page of releases with titles matching a search query, best
+matches first. Returns the page and the number of pages """
+
+
+def render_search(query, page):
+    results = title_index.search(query, search_limit)
+    start = page * page_size
+    rows = [f"{date.strftime('%d %b %Y')}:  {title}\n"
+            for date, title in results[start:start + page_size]]
+    return (f"{len(results)} matching games\n\n" + ''.join(rows),
+            page_count(len(results)))
+
+
+""" Error embed naming filters that match no platform, genre or developer
+in the loaded releases, or None if all filters are known """
+
+
+def check_filters(filters):
+    unknown = [term for term in filters
+               if release_index.filter_column(term) is None]
+    if not unknown:
+        return None
+    return discord.Embed(title="Error",
+                         description=f"No platform, genre or developer matches {', '.join(unknown)}",
+                         color=c_error)
+
+
+def filter_label(filters):
+    return f" ({', '.join(filters)})" if filters else ""
+
+
+""" Render releases on a date matching filters for daily notifications """
+
+
+def render_day(date, filters=()):
+    titles = release_index.day(date, filters).titles()
+    return (f"{len(titles)} games released\n\n"
+            + ''.join(f"{title}\n" for title in titles))
+
+
+""" Render a page of releases matching filters in the 7 days before a
+date and on the date. Pages run through last week's releases and then
+today's. Returns the page and the number of pages """
+
+
+def render_new(date, filters, page):
+    last_week = release_index.between(date - datetime.timedelta(days=7),
+                                      date, 'left', filters)
+    today = release_index.day(date, filters)
+    start = page * page_size
+    end = start + page_size
+
+    msg = ''
+    if page == 0 or start < len(last_week):
+        msg += (f"Last 7 days: {len(last_week)} games released\n\n"
+                + ''.join(f"{d.strftime('%d')} {d.strftime('%b')}:  {title}\n"
+                          for d, title in last_week[start:end]))
+    if end > len(last_week):
+        msg += (("\n" if msg else "")
+                + f"Today: {len(today)} games released\n\n"
+                + ''.join(f"{title}\n" for title in
+                          today[max(start - len(last_week), 0):
+                                end - len(last_week)].titles()))
+    return msg, page_count(len(last_week) + len(today))
+
+
+""" Render a page of releases matching filters in the 7 days after a
+date. Returns the page and the number of pages """
+
+
+def render_upcoming(date, filters, page):
+    upcoming = release_index.between(date, date + datetime.timedelta(days=7),
+                                     'right', filters)
+    start = page * page_size
+    rows = [f"{d.strftime('%d')} {d.strftime('%b')}:  {title}\n"
+            for d, title in upcoming[start:start + page_size]]
+    return (f"Next 7 days: {len(upcoming)} to be released\n\n" + ''.join(rows),
+            page_count(len(upcoming)))
+
+
+""" Render releases added, removed or re-dated since a date. Returns
+    None if nothing changed """
+
+
+def render_changes(since):
+    changes = year_cache.changes_since(since)
+    if not changes:
+        return None
+
+    def dates(days):
+        return ', '.join(d.strftime('%d %b %Y') for d in days)
+
+    added = []
+    redated = []
+    removed = []
+    for title, (before, after) in sorted(changes.items(),
+                                         key=lambda c: (c[1][1] or c[1][0])[0]):
+        if before is None:
+            added.append(f"{dates(after)}:  {title}\n")
+        elif after is None:
+            removed.append(f"{title} (was {dates(before)})\n")
+        else:
+            redated.append(f"{title}: {dates(before)} -> {dates(after)}\n")
+
+    msg = f"{len(changes)} changes since {since.strftime('%d %B %H:%M')} (UTC+0)\n"
+    for heading, rows in (("Newly announced", added),
+                          ("Release date changed", redated),
+                          ("Removed", removed)):
+        if rows:
+            msg += f"\n{heading}: {len(rows)}\n" + ''.join(rows)
+    if len(msg) > embed_limit:
+        msg = msg[:embed_limit - 20].rsplit('\n', 1)[0] + "\n...and more"
+    return msg
+
+
+""" Sends release listings a page at a time, with reactions to move
+    between pages. Pages are rendered from the release index when first
+    shown and then reused from the render cache, so turning a page never
+    fetches data again. The most recent paged messages are remembered so
+    reactions on them can be handled."""
+
+
+class Pager:
+
+    buttons = {'◀': -1, '▶': 1}
+
+    def __init__(self, max_messages):
+        self.max_messages = max_messages
+        self.messages = OrderedDict()
+
+    async def send(self, ctx, title, url, key, years, render, *args):
+        msg, pages = rendered.get(key + (0,), years, render, *args, 0)
+        message = await ctx.send(embed=self.embed(title, url, msg, 0, pages,
+                                                  staleness_note(years)))
+        if pages == 1:
+            return
+
+        self.messages[message.id] = {'message': message, 'title': title,
+                                     'url': url, 'key': key, 'years': years,
+                                     'render': render, 'args': args,
+                                     'page': 0, 'pages': pages}
+        while len(self.messages) > self.max_messages:
+            self.messages.popitem(last=False)
+        try:
+            for emoji in self.buttons:
+                await message.add_reaction(emoji)
+        except discord.HTTPException as e:
+            # Without reactions only the first page can be shown
+            print(f"Cannot add page buttons: {e}")
+
+    async def turn(self, payload):
+        state = self.messages.get(payload.message_id)
+        step = self.buttons.get(str(payload.emoji))
+        if state is None or step is None or payload.user_id == client.user.id:
+            return
+
+        page = state['page'] + step
+        if not 0 <= page < state['pages']:
+            return
+        # The number of pages can change if the data was refreshed since
+        msg, pages = rendered.get(state['key'] + (page,), state['years'],
+                                  state['render'], *state['args'], page)
+        state['page'], state['pages'] = page, pages
+        self.messages.move_to_end(payload.message_id)
+        await state['message'].edit(embed=self.embed(
+            state['title'], state['url'], msg, page, pages,
+            staleness_note(state['years'])))
+
+    def embed(self, title, url, msg, page, pages, note=None):
+        em = discord.Embed(title=title, description=msg, color=c_info)
+        if url is not None:
+            em.url = url
+        footer = [note] if note is not None else []
+        if pages > 1:
+            footer.insert(0, f"Page {page + 1}/{pages}")
+        if footer:
+            em.set_footer(text=" | ".join(footer))
+        return em
+
+
+pager = Pager(max_messages=paged_messages)
+
+
+""" In-memory schedule of channel notifications, grouped into time slots.
+    Each channel is placed in the first slot at or after its notify date,
+    so a whole slot falls due at once and is delivered as one batch. A
+    min-heap of slot dates gives the next due slot in O(1) and the
+    notification loop sleeps exactly until then. Slots emptied by
+    rescheduled or cancelled channels are skipped when they reach the top
+    of the heap."""
+
+
+class NotificationScheduler:
+
+    def __init__(self, slot):
+        self.slot = slot
+        self.heap = []
+        self.slots = {}
+        self.due = {}
+        self.changed = asyncio.Event()
+
+    def slot_date(self, notify_date):
+        # Round up so no channel is notified before its time
+        offset = (notify_date - datetime.datetime.min) % self.slot
+        return notify_date + (self.slot - offset) if offset else notify_date
+
+    def schedule(self, channel_id, notify_date):
+        self.cancel(channel_id)
+        slot_date = self.slot_date(notify_date)
+        channels = self.slots.get(slot_date)
+        if channels is None:
+            channels = self.slots[slot_date] = {}
+            heapq.heappush(self.heap, slot_date)
+        channels[channel_id] = notify_date
+        self.due[channel_id] = slot_date
+        self.changed.set()
+
+    def cancel(self, channel_id):
+        slot_date = self.due.pop(channel_id, None)
+        if slot_date is not None:
+            channels = self.slots[slot_date]
+            del channels[channel_id]
+            if not channels:
+                del self.slots[slot_date]
+        self.changed.set()
+
+    def clear(self):
+        self.heap.clear()
+        self.slots.clear()
+        self.due.clear()
+        self.changed.set()
+
+    def next_due(self):
+        # Drop emptied slots
+        while self.heap:
+            if self.heap[0] in self.slots:
+                return self.heap[0]
+            heapq.heappop(self.heap)
+        return None
+
+    def pop_due(self, curr_date):
+        rows = []
+        while True:
+            slot_date = self.next_due()
+            if slot_date is None or slot_date > curr_date:
+                return rows
+            heapq.heappop(self.heap)
+            for channel_id, notify_date in self.slots.pop(slot_date).items():
+                del self.due[channel_id]
+                rows.append({'_id': channel_id, 'notify_date': notify_date})
+
+    async def wait(self):
+        # Sleep until the next slot is due, waking early if the schedule
+        # changes
+        while True:
+            self.changed.clear()
+            slot_date = self.next_due()
+            timeout = None
+            if slot_date is not None:
+                timeout = (slot_date - datetime.datetime.utcnow()).total_seconds()
+                if timeout <= 0:
+                    return
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                return
+
+
+scheduler = NotificationScheduler(notify_slot)
+
+
+""" Spaces out calls so no more than rate happen per second. discord.py
+    already waits out per-route buckets and 429s, so this only keeps
+    large fan-outs from running into the global limit in the first
+    place."""
+
+
+class RateLimiter:
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_time = 0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+send_limiter = RateLimiter(notify_rate)
+send_slots = asyncio.Semaphore(notify_concurrency)
 
 
 @client.event
 async def on_ready():
     print("Ready as {0.user}".format(client))
-    check_notifications.start()
+    if not check_notifications.is_running():
+        check_notifications.start()
+        client.loop.create_task(warm_up())
+        if os.getenv('WATCH_SUBSCRIPTIONS'):
+            client.loop.create_task(watch_subscriptions())
+        if metrics_port:
+            await metrics.start_server(int(metrics_port))
+            print(f"Serving metrics on port {metrics_port}")
 
 
+""" Time every command from invocation to completion, including failed
+    ones """
+
+
+@client.before_invoke
+async def start_command_timer(ctx):
+    ctx.started = time.perf_counter()
+
+
+@client.after_invoke
+async def stop_command_timer(ctx):
+    command_seconds.observe(time.perf_counter() - ctx.started,
+                            command=ctx.command.qualified_name)
+
+
+""" Prefetch release data for every supported year, from first_year to
+    next year, a few at a time. Commands for a year are served as soon
+    as that year is ready. Once done, the current and next year are
+    kept fresh in the background."""
+
+
+async def warm_up():
+    curr_year = datetime.datetime.utcnow().year
+    years = range(first_year, curr_year + 2)
+    slots = asyncio.Semaphore(warm_up_concurrency)
+    start = time.monotonic()
+    ready = 0
+
+    async def prefetch(year):
+        nonlocal ready
+        async with slots:
+            try:
+                await get_year_data(year)
+                ready += 1
+                status = "ready"
+            except Exception as e:
+                status = f"failed ({type(e).__name__}: {e})"
+        print(f"Warm-up {year}: {status} "
+              f"({ready}/{len(years)} years ready)")
+
+    await asyncio.gather(*[prefetch(year) for year in years])
+    print(f"Warm-up finished in {time.monotonic() - start:.1f}s, "
+          f"{ready}/{len(years)} years ready")
+    if not refresh_current_years.is_running():
+        refresh_current_years.start()
+
+
+""" Revalidate current and next year's release data ahead of the cache
+    TTL, so commands never wait on Wikipedia for them."""
+
+
+@tasks.loop(seconds=refresh_interval)
+async def refresh_current_years():
+    # Data was fetched by the warm-up just before the first iteration
+    if refresh_current_years.current_loop == 0:
+        return
+    curr_year = datetime.datetime.utcnow().year
+    for year in (curr_year, curr_year + 1):
+        try:
+            await get_year_data(year, force=True)
+        except WikipediaUnavailable as e:
+            print(f"Skipped refreshing {year}: {e}")
+        except Exception as e:
+            print(traceback.format_exc())
+
+
+
+""" Turn pages of paged listings. Removing a reaction turns the page as
+    well, so each button can be pressed repeatedly without the bot having
+    to remove reactions """
+
+
+@client.event
+async def on_raw_reaction_add(payload):
+    await pager.turn(payload)
+
+
+@client.event
+async def on_raw_reaction_remove(payload):
+    await pager.turn(payload)
+
 
 """ Check for errors raised after invoking commands """
 
@@ -100,6 +941,13 @@ async def on_command_error(ctx, error):
                            color=c_error)
         await ctx.send(embed=em)
 
+    # Send error message if operator-only command used by another user
+    elif isinstance(error, commands.NotOwner):
+        em = discord.Embed(title="Error",
+                           description="Only the bot owner can use this command",
+                           color=c_error)
+        await ctx.send(embed=em)
+
 
 
 """ Display embedded list of commands with their names and descriptions """
@@ -118,6 +966,8 @@ async def help(ctx, command_name=None):
     if command_name is None:
         # Display command names and brief description as default
         for c in commands.values():
+            if c.hidden:
+                continue
             em.add_field(name=f"{c.name} {c.signature}",
                          value=c.brief,
                          inline=False)
@@ -138,6 +988,51 @@ async def help(ctx, command_name=None):
         
 
 
+""" Force cached release data to be revalidated against Wikipedia and
+    display cache statistics. Only available to the bot owner. """
+
+
+@client.command(name='refresh', hidden=True,
+                help="""Revalidate cached release data against Wikipedia.\n
+                        - Refresh all cached years: !refresh
+                        - Refresh a single year: !refresh [year]""",
+                brief="Revalidate cached release data")
+@commands.bot_has_permissions(embed_links=True)
+@commands.is_owner()
+async def refresh_cache(ctx, year=None):
+    try:
+        years = year_cache.stats()['years'] if year is None else [int(year)]
+        for y in years:
+            await get_year_data(y, force=True)
+        stats = year_cache.stats()
+
+        msg = (f"Refreshed: {', '.join(map(str, years)) or 'nothing cached'}\n"
+               f"Cached years: {', '.join(map(str, stats['years']))}")
+        em = discord.Embed(title="Cache Refreshed",
+                           description=msg,
+                           color=c_info)
+        em.add_field(name="Hits / Misses",
+                     value=f"{stats['hits']} / {stats['misses']} "
+                           f"({stats['hit_rate']:.0%} hit rate)",
+                     inline=False)
+        em.add_field(name="Revalidated / Re-parsed",
+                     value=f"{stats['revalidated']} / {stats['refreshed']}",
+                     inline=False)
+        em.add_field(name="Release Data Memory",
+                     value=f"{stats['memory'] / 1024:.0f} KiB",
+                     inline=False)
+        await ctx.send(embed=em)
+
+    except Exception as e:
+        print(traceback.format_exc())
+        msg = "Unable to get required data!"
+        title = "Error"
+        em = discord.Embed(title=title,
+                           description=msg,
+                           color=c_error)
+        await ctx.send(embed=em)
+
+
 """ List video game releases for chosen month and year,
 sorted by date, in embed"""
 
@@ -148,13 +1043,21 @@ sorted by date, in embed"""
                      - Get releases for a different month of year: !list [month]
                        (e.g. !list january)
                      - Get releases for different month and year: !list [month] [year]
-                       (e.g. !list august 2020)\n
+                       (e.g. !list august 2020)
+                     - Only list releases for some platforms, genres or developers: !list [month] [year] [filters]
+                       (e.g. !list august 2020 switch rpg)\n
                      NB: Can only go back upto 2015 currently""",
                 brief="List video game releases for given month and year")
 @commands.bot_has_permissions(embed_links=True)
-async def list_releases(ctx, month=None, year=None):
+async def list_releases(ctx, month=None, year=None, *filters):
     curr_date = ctx.message.created_at
 
+    # Month and year can be left out before filters
+    args = [a for a in (month, year) if a is not None] + list(filters)
+    month = args.pop(0) if args and args[0].title() in month_names else None
+    year = args.pop(0) if args and args[0].isdigit() else None
+    filters = normalize_filters(args)
+
     # Use date that message sent as default arguments, else get user input
     if month is None:
         curr_month = curr_date.strftime('%B')
@@ -166,20 +1069,16 @@ async def list_releases(ctx, month=None, year=None):
         curr_year = year
 
     try:
-        df, wiki_url = get_year_data(curr_year)
-        df = df[df['Date'].dt.strftime('%B') == curr_month]
-        df['Day'] = df['Date'].dt.strftime('%d')
-
-        # Construct list of games ordered by date
-        games = tuple(zip(df['Day'], df['Title']))
-        msg = f"{len(games)} games released this month\n\n"
-        for day, title in games:
-            msg += f"{day}  {title}\n"
-
-        embed = discord.Embed(title=f"Releases for {curr_month} {curr_year}",
-                              url=wiki_url, description=msg,
-                              color=c_info)
-        await ctx.send(embed=embed)
+        wiki_url = (await get_year_data(curr_year))[1]
+        curr_year = int(curr_year)
+        month_num = month_names.index(curr_month) + 1
+        error = check_filters(filters)
+        if error is not None:
+            return await ctx.send(embed=error)
+        await pager.send(ctx, f"Releases for {curr_month} {curr_year}"
+                         + filter_label(filters),
+                         wiki_url, ('list', curr_year, month_num, filters),
+                         [curr_year], render_month, curr_year, month_num, filters)
 
     except Exception as e:
         print(traceback.format_exc())
@@ -195,47 +1094,29 @@ async def list_releases(ctx, month=None, year=None):
 
 
 @client.command(name='new',
-                help="Show games released in past 7 days and today",
+                help="""Show games released in past 7 days and today\n
+                     - Only show releases for some platforms, genres or developers: !new [filters]
+                       (e.g. !new ps5)""",
                 brief="Show games released in past 7 days and today")
 @commands.bot_has_permissions(embed_links=True)
-async def post_new(ctx):
+async def post_new(ctx, *filters):
+    filters = normalize_filters(filters)
     curr_date = ctx.message.created_at.replace(hour=0, minute=0,
                                                second=0, microsecond=0)
     last_date = curr_date - datetime.timedelta(days=7)
     try:
-        df = get_year_data(curr_date.year)[0]
+        await get_year_data(curr_date.year)
         # If there is change in years during week, get data from other year
         if last_date.year != curr_date.year:
-            df_last = get_year_data(last_date.year)[0]
-            df = pd.concat([df, df_last])
-
-        # Get releases in last 7 days and for current day
-        last_week = df[df['Date'].between(last_date,
-                                          curr_date,
-                                          inclusive='left')]
-
-        mask = ((df['Date'].dt.day == curr_date.day)
-                & (df['Date'].dt.month == curr_date.month)
-                & (df['Date'].dt.year == curr_date.year)
-                )
-        today = df.where(mask).dropna()
-
-        # Construct lists of games ordered by date
-        games = tuple(zip(last_week['Date'], last_week['Title']))
-        msg = f"Last 7 days: {len(games)} games released\n\n"
-        for date, title in games:
-            row = f"{date.strftime('%d')} {date.strftime('%b')}:  {title}\n"
-            msg += row
-
-        games = tuple(zip(today['Date'], today['Title']))
-        msg += f"\nToday: {len(games)} games released\n\n"
-        for date, title in games:
-            msg += f"{title}\n"
-
-        em = discord.Embed(title="Newest Releases",
-                           description=msg,
-                           color=c_info)
-        await ctx.send(embed=em)
+            await get_year_data(last_date.year)
+
+        error = check_filters(filters)
+        if error is not None:
+            return await ctx.send(embed=error)
+        await pager.send(ctx, "Newest Releases" + filter_label(filters), None,
+                         ('new', curr_date.date(), filters),
+                         {last_date.year, curr_date.year},
+                         render_new, curr_date, filters)
 
     except Exception as e:
         print(traceback.format_exc())
@@ -250,37 +1131,68 @@ async def post_new(ctx):
 """ List games to be released in next 7 days in an embed."""
 
 
-@client.command(name='soon', help="Show games releasing in the next 7 days",
+@client.command(name='soon',
+                help="""Show games releasing in the next 7 days\n
+                     - Only show releases for some platforms, genres or developers: !soon [filters]
+                       (e.g. !soon switch, or !soon "xbox one" for names with spaces)""",
                 brief="Show games releasing in the next 7 days")
 @commands.bot_has_permissions(embed_links=True)
-async def post_upcoming(ctx):
+async def post_upcoming(ctx, *filters):
+    filters = normalize_filters(filters)
     curr_date = ctx.message.created_at.replace(hour=0, minute=0,
                                                second=0, microsecond=0)
     end_date = curr_date + datetime.timedelta(days=7)
 
     try:
-        df = get_year_data(curr_date.year)[0]
+        await get_year_data(curr_date.year)
         # If there is change in years during week, get data from other year
         if end_date.year != curr_date.year:
-            df_last = get_year_data(end_date.year)[0]
-            df = pd.concat([df, df_last])
+            await get_year_data(end_date.year)
 
-        upcoming = df[df['Date'].between(curr_date,
-                                         end_date,
-                                         inclusive='right')]
+        error = check_filters(filters)
+        if error is not None:
+            return await ctx.send(embed=error)
+        await pager.send(ctx, "Upcoming Releases" + filter_label(filters), None,
+                         ('soon', curr_date.date(), filters),
+                         {curr_date.year, end_date.year},
+                         render_upcoming, curr_date, filters)
 
-        # Construct list of games ordered by date
-        games = tuple(zip(upcoming['Date'], upcoming['Title']))
-        msg = f"Next 7 days: {len(games)} to be released\n\n"
-        for date, title in games:
-            row = f"{date.strftime('%d')} {date.strftime('%b')}:  {title}\n"
-            msg += row
-
-        em = discord.Embed(title="Upcoming Releases",
+    except Exception as e:
+        print(traceback.format_exc())
+        msg = "Unable to get required data!"
+        title = "Error"
+        em = discord.Embed(title=title,
                            description=msg,
-                           color=c_info)
+                           color=c_error)
         await ctx.send(embed=em)
 
+
+""" Search release titles across all loaded years in an embed.
+    Matches whole words, beginnings of words and close misspellings."""
+
+
+@client.command(name='search', help="""
+                    Search for games by title across all years\n
+                     - Find releases of a game: !search [title]
+                       (e.g. !search zelda)
+                     - Words can be shortened or slightly misspelt
+                       (e.g. !search assasins cre)""",
+                brief="Search for games by title across all years")
+@commands.bot_has_permissions(embed_links=True)
+async def search_releases(ctx, *, query=None):
+    words = tokenize(query or '')
+    if not words:
+        em = discord.Embed(title="Error",
+                           description=f"Enter a title to search for, e.g. {prefix}search zelda",
+                           color=c_error)
+        return await ctx.send(embed=em)
+
+    try:
+        # Years still being loaded after a restart are searched once ready
+        await pager.send(ctx, f"Search Results for {query.strip()[:200]}", None,
+                         ('search', ' '.join(words)), list(release_index.years),
+                         render_search, ' '.join(words))
+
     except Exception as e:
         print(traceback.format_exc())
         msg = "Unable to get required data!"
@@ -306,7 +1218,7 @@ async def post_upcoming(ctx):
                         [clock_time] is a 4 digit number which gives the time of day in 24h clock format.
                         e.g. to set notifications for 6:30 PM, !notify 1830.
                         e.g. to set notifications for 4:15 AM, !notify 0415\n
-                        Notification dates are given in UTC+0 timezone format.\n
+                        Times are in the server's timezone, which is UTC+0 unless set with !timezone.\n
                         Note: Users must have permission to Manage Messages to use notification system.""",
                 brief="Enable daily notifications about releases in the current channel")
 @commands.bot_has_permissions(embed_links=True)
@@ -315,11 +1227,39 @@ async def notify(ctx, clock_time=None):
     channel = ctx.message.channel
     curr_date = ctx.message.created_at
     next_date = curr_date + datetime.timedelta(hours=24)
-    data = await db_table.find_one({'_id': channel.id})
+    # New channels use the timezone already set for the server
+    timezone = await subscriptions.find_timezone(server_channel_ids(ctx))
+
+    if clock_time is not None:
+        try:
+            # Check input is 4 characters long and try to convert to 24h clock time
+            assert(len(clock_time) == 4)
+            time_set = time.strptime(clock_time, "%H%M")
+            notify_time = time_set.tm_hour * 60 + time_set.tm_min
+            notify_date = local_date(to_local(next_date, timezone).date(),
+                                     minute_clock(notify_time), timezone)
+        except (ValueError, AssertionError) as e:
+            print(traceback.format_exc())
+            # Send error message embed if input is invalid
+            msg = """Invalid time of day given!
+                     It must be a valid 4-digit 24h clock time between 0000-2359."""
+            title = "Error"
+            em = discord.Embed(title=title,
+                               description=msg,
+                               color=c_error)
+            return await ctx.send(embed=em)
+    else:
+        # Whole minutes, as notifications are sent in minute slots
+        notify_date = next_date.replace(second=0, microsecond=0)
+        notify_time = local_minute(notify_date, timezone)
+
+    # Add new document for channel unless it already has one
+    data = await subscriptions.add(channel.id, notify_date, notify_time, timezone)
 
     if data is not None:
         # Show current notification date for channel
         notify_date = data['notify_date']
+        timezone = data.get('timezone')
         msg = f"""To change notification time, type {prefix}set
                   To stop notifications in this channel, type {prefix}stop"""
         title = "Found Existing Subscription"
@@ -327,35 +1267,13 @@ async def notify(ctx, clock_time=None):
                        description=msg,
                        color=c_info)
         em.add_field(name="Next Notification Due",
-                     value=notify_date.strftime("%d %B %Y %H:%M (UTC+0)"),
+                     value=format_notify_date(notify_date, timezone),
                      inline=False)
         await ctx.send(embed=em)
 
     else:
-        if clock_time is not None:
-            try:
-                # Check input is 4 characters long and try to convert to 24h clock time
-                assert(len(clock_time) == 4)
-                time_set = time.strptime(clock_time, "%H%M")
-                notify_date = datetime.datetime(next_date.year, next_date.month,
-                                                next_date.day, time_set.tm_hour,
-                                                time_set.tm_min, 0, 0)
-            except (ValueError, AssertionError) as e:
-                print(traceback.format_exc())
-                # Send error message embed if input is invalid
-                msg = """Invalid time of day given!
-                         It must be a valid 4-digit 24h clock time between 0000-2359."""
-                title = "Error"
-                em = discord.Embed(title=title,
-                                   description=msg,
-                                   color=c_error)
-                return await ctx.send(embed=em)
-        else:
-            notify_date = next_date
-
-        # Add new document for channel and display success message
-        new_doc = {'_id': channel.id, 'notify_date': notify_date}
-        result = await db_table.insert_one(new_doc)
+        # Display success message for new subscription
+        scheduler.schedule(channel.id, notify_date)
 
         msg = f"""{ctx.message.author} has enabled daily notifications about releases in {channel}.\n
                   To change notification time, type {prefix}set
@@ -365,7 +1283,7 @@ async def notify(ctx, clock_time=None):
                        description=msg,
                        color=c_info)
         em.add_field(name="Next Notification Due",
-                     value=notify_date.strftime("%d %B %Y %H:%M (UTC+0)"),
+                     value=format_notify_date(notify_date, timezone),
                      inline=False)
         await ctx.send(embed=em)
 
@@ -387,11 +1305,11 @@ async def remove_from_notify(ctx):
     msg = ""
     title = ""
     colour = c_info
-    data = await db_table.find_one({'_id': channel.id})
+    data = await subscriptions.remove(channel.id)
 
-    # If channel in database, remove and post confirmation message
+    # If channel was in database, post confirmation message
     if data is not None:
-        result = await db_table.delete_one(data)
+        scheduler.cancel(channel.id)
         msg = f"Daily notifications for {channel} disabled by {ctx.message.author}"
         title = "Channel Unsubscribed"
 
@@ -419,7 +1337,7 @@ async def remove_from_notify(ctx):
                         The <clock_time> required argument is a 4 digit number which gives the time of day in 24h clock format.
                         e.g. to set notifications for 6:30 PM, !notify 1830.
                         e.g. to set notifications for 4:15 AM, !notify 0415\n
-                        Notification dates are given in UTC+0 timezone format.\n
+                        Times are in the server's timezone, which is UTC+0 unless set with !timezone.\n
                         Note: Users must have permission to Manage Messages to use notification system.""",
                 brief="Set new time for channel daily notifications")
 @commands.bot_has_permissions(embed_links=True)
@@ -427,22 +1345,25 @@ async def remove_from_notify(ctx):
 async def set_notify_time(ctx, clock_time):
     channel = ctx.message.channel
     try:
-        data = await db_table.find_one({'_id': channel.id})
+        data = await subscriptions.get(channel.id)
         if data is not None:
             # Check input is 4 characters long and convert to 24h clock format
             # Then use it to get new notification date
             assert(clock_time is not None)
             assert(len(clock_time) == 4)
             time_set = time.strptime(clock_time, "%H%M")
-            old_date = data['notify_date']
-            notify_date = datetime.datetime(old_date.year, old_date.month,
-                                            old_date.day, time_set.tm_hour,
-                                            time_set.tm_min, 0, 0)
+            timezone = data.get('timezone')
+            notify_time = time_set.tm_hour * 60 + time_set.tm_min
+            notify_date = local_date(
+                to_local(data['notify_date'], timezone).date(),
+                minute_clock(notify_time), timezone)
 
             # Find document for channel and update notification date
-            find_query = {'_id': data['_id']}
-            update_query = {'$set': {'notify_date': notify_date}}
-            result = await db_table.update_one(find_query, update_query)
+            data = await subscriptions.set_date(channel.id, notify_date,
+                                                notify_time)
+
+        if data is not None:
+            scheduler.schedule(channel.id, next_check_date(data))
 
             # Send success message with new date and time
             msg = f"{ctx.message.author} set a new notification time for {channel}"
@@ -450,7 +1371,7 @@ async def set_notify_time(ctx, clock_time):
                                description=msg,
                                color=c_info)
             em.add_field(name="New Notification Time",
-                         value=notify_date.strftime("%d %B %Y %H:%M (UTC+0)"),
+                         value=format_notify_date(notify_date, timezone),
                          inline=False)
             await ctx.send(embed=em)
 
@@ -478,60 +1399,508 @@ async def set_notify_time(ctx, clock_time):
 
 
 
+""" Show releases added, removed or re-dated on Wikipedia in the last day.
+    With on or off, enable or disable adding these changes to the
+    channel's daily notifications, which requires permission to manage
+    messages. """
+
+
+@client.command(name='changes',
+                help="""Show releases added, removed or re-dated in the last 24 hours.\n
+                        - Show changes: !changes
+                        - Add changes to daily notifications in this channel: !changes on
+                        - Stop adding changes to daily notifications: !changes off\n
+                        Note: Users must have permission to Manage Messages to change notification settings.""",
+                brief="Show changes to release dates in the last 24 hours")
+@commands.bot_has_permissions(embed_links=True)
+async def post_changes(ctx, setting=None):
+    channel = ctx.message.channel
+    if setting is None:
+        since = ctx.message.created_at - datetime.timedelta(days=1)
+        msg = render_changes(since) or "No changes to releases in the last 24 hours"
+        em = discord.Embed(title="Release Changes",
+                           description=msg,
+                           color=c_info)
+        return await ctx.send(embed=em)
+
+    if not channel.permissions_for(ctx.message.author).manage_messages:
+        raise commands.MissingPermissions(['manage_messages'])
+
+    if setting.lower() not in ('on', 'off'):
+        em = discord.Embed(title="Error",
+                           description=f"Setting must be on or off, not {setting}",
+                           color=c_error)
+        return await ctx.send(embed=em)
+
+    enabled = setting.lower() == 'on'
+    data = await subscriptions.set_changes(channel.id, enabled)
+    if data is not None:
+        state = "added to" if enabled else "removed from"
+        msg = f"{ctx.message.author}: release changes will be {state} daily notifications in {channel}"
+        em = discord.Embed(title="Notification Settings Changed",
+                           description=msg,
+                           color=c_info)
+    else:
+        msg = f"""Channel does not receive notifications!
+                  To start notifications type {prefix}notify"""
+        em = discord.Embed(title="Error",
+                           description=msg,
+                           color=c_error)
+    await ctx.send(embed=em)
+
+
+
+
+""" Set or clear filters for releases in a channel's daily notifications.
+    Requires users to have permission to manage messages. """
+
+
+@client.command(name='filter',
+                help="""Only notify this channel of releases for some platforms, genres or developers.\n
+                        - Set filters: !filter [filters]
+                          (e.g. !filter switch ps5 for releases on either platform,
+                           or !filter switch rpg for RPGs on Switch)
+                        - Notify of all releases again: !filter\n
+                        Note: Users must have permission to Manage Messages to use this command.""",
+                brief="Filter releases in this channel's daily notifications")
+@commands.bot_has_permissions(embed_links=True)
+@commands.has_permissions(manage_messages=True)
+async def set_notify_filters(ctx, *filters):
+    channel = ctx.message.channel
+    filters = normalize_filters(filters)
+    try:
+        await get_year_data(ctx.message.created_at.year)
+        error = check_filters(filters)
+        if error is not None:
+            return await ctx.send(embed=error)
+        data = await subscriptions.set_filters(channel.id, filters)
+
+    except Exception as e:
+        print(traceback.format_exc())
+        em = discord.Embed(title="Error",
+                           description="Unable to get required data!",
+                           color=c_error)
+        return await ctx.send(embed=em)
+
+    if data is not None:
+        if filters:
+            msg = f"{ctx.message.author}: daily notifications in {channel} will only list releases for {', '.join(filters)}"
+        else:
+            msg = f"{ctx.message.author}: daily notifications in {channel} will list all releases"
+        em = discord.Embed(title="Notification Settings Changed",
+                           description=msg,
+                           color=c_info)
+    else:
+        msg = f"""Channel does not receive notifications!
+                  To start notifications type {prefix}notify"""
+        em = discord.Embed(title="Error",
+                           description=msg,
+                           color=c_error)
+    await ctx.send(embed=em)
+
+
+""" Show or set the timezone of the server's notifications. The timezone
+    is kept with each subscribed channel of the server, so setting it
+    requires at least one channel to be subscribed. Setting it requires
+    users to have permission to manage messages. """
+
+
+@client.command(name='timezone',
+                help="""Show or set the timezone used for notification times in this server.\n
+                        - Show the timezone: !timezone
+                        - Set the timezone: !timezone [name]
+                          (e.g. !timezone Europe/London or !timezone America/New_York)
+                        - Go back to UTC+0: !timezone utc\n
+                        Notifications are sent at the same time as before, which is then shown in the new timezone.
+                        Change the time with !set.\n
+                        Note: Users must have permission to Manage Messages to set the timezone.""",
+                brief="Show or set the timezone for notifications in this server")
+@commands.bot_has_permissions(embed_links=True)
+async def set_timezone(ctx, name=None):
+    channel = ctx.message.channel
+    channel_ids = server_channel_ids(ctx)
+    if name is None:
+        timezone = await subscriptions.find_timezone(channel_ids)
+        em = discord.Embed(title="Notification Timezone",
+                           description=f"Notification times are in {timezone or 'UTC+0'}",
+                           color=c_info)
+        return await ctx.send(embed=em)
+
+    if not channel.permissions_for(ctx.message.author).manage_messages:
+        raise commands.MissingPermissions(['manage_messages'])
+
+    timezone = find_timezone(name)
+    if timezone is None:
+        msg = f"""Unknown timezone {name[:100]}!
+                  Use a name from the tz database, such as Europe/London.
+                  See https://en.wikipedia.org/wiki/List_of_tz_database_time_zones"""
+        em = discord.Embed(title="Error",
+                           description=msg,
+                           color=c_error)
+        return await ctx.send(embed=em)
+    if timezone == 'UTC':
+        timezone = None
+
+    rows = await subscriptions.set_timezone(channel_ids, timezone)
+    if rows:
+        msg = f"{ctx.message.author}: notification times in {len(rows)} subscribed channels are now in {timezone or 'UTC+0'}"
+        em = discord.Embed(title="Notification Settings Changed",
+                           description=msg,
+                           color=c_info)
+        row = next((row for row in rows if row['_id'] == channel.id), None)
+        if row is not None:
+            em.add_field(name="Next Notification Due",
+                         value=format_notify_date(row['notify_date'], timezone),
+                         inline=False)
+    else:
+        msg = f"""No channels in this server receive notifications!
+                  To start notifications type {prefix}notify"""
+        em = discord.Embed(title="Error",
+                           description=msg,
+                           color=c_error)
+    await ctx.send(embed=em)
+
+
+def server_channel_ids(ctx):
+    if ctx.guild is None:
+        return [ctx.channel.id]
+    return [channel.id for channel in ctx.guild.text_channels]
+
+
 """ Scrape release data from Wikipedia for current date and
-    post notification to any subscribed channels."""
+    post notification to any subscribed channels. Sleeps until the
+    scheduler's next due notification instead of polling the database."""
 
 
-@tasks.loop(minutes=5)
+@tasks.loop(seconds=0)
 @commands.bot_has_permissions(embed_links=True)
 async def check_notifications():
+    await scheduler.wait()
+    curr_date = datetime.datetime.utcnow()
+    data = scheduler.pop_due(curr_date)
+    if not data:
+        return
+
+    # Leave channels on other shards to their own instance unless they
+    # are overdue by a full lease, in case that instance is down
+    claim_ids = []
+    for row in data:
+        if (client.get_channel(row['_id']) is not None
+                or curr_date - row['notify_date'] >= lease_duration):
+            claim_ids.append(row['_id'])
+        else:
+            scheduler.schedule(row['_id'], row['notify_date'] + lease_duration)
+
     try:
-        curr_date = datetime.datetime.now()
-        data = db_table.find({'notify_date': {'$lte': curr_date}})
-        if data is not None:
-            # Get releases for current date
-            df = get_year_data(curr_date.year)[0]
-            mask = ((df['Date'].dt.day == curr_date.day)
-                    & (df['Date'].dt.month == curr_date.month)
-                    & (df['Date'].dt.year == curr_date.year)
-                    )
-            today = df.where(mask).dropna()
-
-            # Construct list of releases sorted by date
-            games = tuple(zip(today['Date'], today['Title']))
-            msg = f"{len(games)} games released\n\n"
-            for date, title in games:
-                msg += f"{title}\n"
-
-            # Set new future notification date for each channel
-            for row in await data.to_list(length=None):
-                old_dt = row['notify_date']
-                notify_date = ((curr_date + datetime.timedelta(hours=24))
-                               .replace(hour=old_dt.hour,
-                                        minute=old_dt.minute,
-                                        second=old_dt.second,
-                                        microsecond=0)
-                               )
-                find_query = {'_id': row['_id']}
-                update_query = {'$set': {'notify_date': notify_date}}
-                result = await db_table.update_one(find_query, update_query)
-
-                # Create embed with the releases list and post to
-                # subscribed channel
-                em = discord.Embed(title="Today's Releases",
-                                   description=msg,
-                                   color=c_info)
-                em.add_field(
-                    name="Next Notification Due",
-                    value=notify_date.strftime("%d %B %Y %H:%M (UTC+0)"),
-                    inline=False)
-                channel = client.get_channel(row['_id'])
-                await channel.send(embed=em)
-                
+        token, claimed = await claim_notifications(claim_ids, curr_date)
+        if not claimed:
+            return
+
+        # Get releases for the date each channel was due in its timezone,
+        # rendered once for each date and set of filters channels use.
+        # Slots round due dates up, so a channel due just before midnight
+        # is sent just after it and must still get the earlier day
+        timezones = {row['_id']: channel_timezone(row) for row in claimed}
+        dates = {row['_id']: due_local_date(row, curr_date, timezones[row['_id']])
+                 for row in claimed}
+        for year in {date.year for date in dates.values()}:
+            await get_year_data(year)
+        msgs = {}
+        for row in claimed:
+            key = (dates[row['_id']], tuple(row.get('filters') or ()))
+            if key not in msgs:
+                msgs[key] = rendered.get(('day',) + key, [key[0].year],
+                                         render_day, *key)
+
+    except Exception as e:
+        print(traceback.format_exc())
+        # Retry channels after a short delay rather than immediately, and
+        # not before Wikipedia may be fetched again
+        retry_date = curr_date + max(
+            notify_retry_delay,
+            datetime.timedelta(seconds=year_cache.breaker.retry_after()))
+        for channel_id in claim_ids:
+            scheduler.schedule(channel_id, retry_date)
+        return
+
+    # Set new future notification date for each channel, at its chosen
+    # time of day in its timezone. The time is stored rather than read
+    # back from the last date, which a DST gap may have moved
+    next_dates = {}
+    notify_times = {}
+    for row in claimed:
+        timezone = timezones[row['_id']]
+        notify_time = row.get('notify_time')
+        if notify_time is None:
+            notify_time = local_minute(row['notify_date'], timezone)
+        notify_times[row['_id']] = notify_time
+        next_dates[row['_id']] = local_date(
+            dates[row['_id']] + datetime.timedelta(days=1),
+            minute_clock(notify_time), timezone)
+
+    # Changes are rendered once for all channels that opted in
+    changes_msg = None
+    wants_changes = {row['_id'] for row in claimed if row.get('changes')}
+    if wants_changes:
+        changes_msg = render_changes(curr_date - datetime.timedelta(days=1))
+
+    # Create embed with the releases list and post to all claimed
+    # channels concurrently
+    note = staleness_note(sorted({date.year for date in dates.values()}))
+    start = time.monotonic()
+    results = await asyncio.gather(*[
+        send_notification(row['_id'],
+                          msgs[(dates[row['_id']], tuple(row.get('filters') or ()))],
+                          next_dates[row['_id']],
+                          changes_msg if row['_id'] in wants_changes else None,
+                          due_date=row['notify_date'], note=note,
+                          timezone=timezones[row['_id']])
+        for row in claimed])
+    elapsed = time.monotonic() - start
+    fanout_rate.set(len(results) / max(elapsed, 1e-3))
+    print(f"Sent {sum(results)}/{len(results)} notifications in "
+          f"{elapsed:.2f}s ({len(results) / max(elapsed, 1e-3):.1f}/s)")
+
+    # Reschedule channels and release their leases in one bulk write.
+    # If this instance stops before here the leases expire and another
+    # instance delivers the notifications instead. Channels stopped or
+    # given a new time while being sent keep the schedule their command
+    # gave them
+    due_dates = {row['_id']: row['notify_date'] for row in claimed}
+    try:
+        next_dates = await subscriptions.reschedule(token, due_dates, next_dates,
+                                                    notify_times)
     except Exception as e:
         print(traceback.format_exc())
+        unchanged = subscriptions.unchanged(due_dates)
+        next_dates = {channel_id: notify_date
+                      for channel_id, notify_date in next_dates.items()
+                      if channel_id in unchanged}
+    for channel_id, notify_date in next_dates.items():
+        scheduler.schedule(channel_id, notify_date)
+
+
+""" Atomically take leases on due channel subscriptions so only one bot
+    instance delivers each notification. A lease can be taken if it is
+    free, expired or already held by this instance. Channels that could
+    not be claimed are rescheduled from their stored state. Returns the
+    claim token and the claimed subscriptions."""
+
+
+async def claim_notifications(channel_ids, curr_date):
+    token = uuid.uuid4().hex
+    if not channel_ids:
+        return token, []
+
+    claimed = await subscriptions.claim(channel_ids, curr_date, instance_id,
+                                        token, curr_date + lease_duration)
+
+    # Channels already delivered or leased by another instance are checked
+    # again once their new date or the lease is due
+    claimed_ids = {row['_id'] for row in claimed}
+    unclaimed = [i for i in channel_ids if i not in claimed_ids]
+    if unclaimed:
+        rows = await subscriptions.find(unclaimed)
+        for row in rows:
+            scheduler.schedule(row['_id'], next_check_date(row))
+            unclaimed.remove(row['_id'])
+        for channel_id in unclaimed:
+            scheduler.cancel(channel_id)
+    return token, claimed
+
+
+""" Date when a stored subscription next needs attention: its notify date,
+    or the end of its lease if another instance is delivering it """
 
 
+def next_check_date(row):
+    lease_until = row.get('lease_until')
+    if lease_until is not None and lease_until > row['notify_date']:
+        return lease_until
+    return row['notify_date']
 
 
-client.run(os.getenv('RELEASES_TOKEN'))
+""" Notify dates are stored in UTC and shown and scheduled in the
+    timezone of the channel's server, given by its name in the tz
+    database. Channels without a timezone use UTC."""
+
+timezone_names = None
+
+
+def find_timezone(name):
+    # Match names regardless of case, e.g. europe/london
+    global timezone_names
+    if timezone_names is None:
+        timezone_names = {key.casefold(): key
+                          for key in zoneinfo.available_timezones()}
+    return timezone_names.get(name.casefold())
+
+
+def get_timezone(name):
+    return zoneinfo.ZoneInfo(name) if name else datetime.timezone.utc
+
+
+def to_local(date, timezone):
+    return date.replace(tzinfo=datetime.timezone.utc).astimezone(
+        get_timezone(timezone))
+
+
+""" UTC date for a time of day on a date in timezone """
+
+
+def local_date(date, clock, timezone):
+    local = datetime.datetime.combine(date, clock, tzinfo=get_timezone(timezone))
+    return local.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+""" Timezone name to use for a subscription, falling back to UTC if its
+    stored zone can no longer be loaded so one channel cannot hold back
+    the rest of its slot """
+
+
+def channel_timezone(row):
+    timezone = row.get('timezone')
+    try:
+        get_timezone(timezone)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        print(f"Unknown timezone {timezone!r} for channel {row['_id']}, using UTC")
+        return None
+    return timezone
+
+
+""" Local date a subscription was due on, or the current local date if
+    it is overdue by more than a day so missed days are not replayed """
+
+
+def due_local_date(row, curr_date, timezone):
+    if curr_date - row['notify_date'] > datetime.timedelta(days=1):
+        return to_local(curr_date, timezone).date()
+    return to_local(row['notify_date'], timezone).date()
+
+
+""" Notification times of day are stored as the minute of the day in
+    the channel's timezone """
+
+
+def local_minute(date, timezone):
+    local = to_local(date, timezone)
+    return local.hour * 60 + local.minute
+
+
+def minute_clock(minute):
+    return datetime.time(*divmod(minute, 60))
+
+
+def format_notify_date(date, timezone):
+    return (to_local(date, timezone).strftime("%d %B %Y %H:%M")
+            + f" ({timezone or 'UTC+0'})")
+
+
+""" Post daily releases embed to a subscribed channel. Sends are limited
+    in number and rate so a large fan-out stays under Discord's global
+    rate limit, and failed sends are retried with exponential backoff.
+    Returns whether the notification was delivered."""
+
+
+async def send_notification(channel_id, msg, notify_date, changes_msg=None,
+                            due_date=None, note=None, timezone=None):
+    em = discord.Embed(title="Today's Releases",
+                       description=msg,
+                       color=c_info)
+    em.add_field(
+        name="Next Notification Due",
+        value=format_notify_date(notify_date, timezone),
+        inline=False)
+    if note is not None:
+        em.set_footer(text=note)
+    embeds = [em]
+    if changes_msg is not None:
+        embeds.append(discord.Embed(title="Changes Since Yesterday",
+                                    description=changes_msg,
+                                    color=c_info))
+
+    async with send_slots:
+        for attempt in range(notify_attempts):
+            try:
+                channel = client.get_channel(channel_id)
+                if channel is None:
+                    channel = await client.fetch_channel(channel_id)
+                # Only resend embeds that failed on an earlier attempt
+                while embeds:
+                    await send_limiter.wait()
+                    await channel.send(embed=embeds[0])
+                    embeds.pop(0)
+                notifications_sent.inc(result='sent')
+                if due_date is not None:
+                    notification_lag.observe(
+                        (datetime.datetime.utcnow() - due_date).total_seconds())
+                return True
+
+            except (discord.Forbidden, discord.NotFound) as e:
+                # Retrying cannot help if the channel is gone or the bot
+                # lost access to it
+                print(f"Cannot notify channel {channel_id}: {e}")
+                notifications_sent.inc(result='unreachable')
+                return False
+            except Exception as e:
+                print(f"Failed to notify channel {channel_id} "
+                      f"(attempt {attempt + 1}/{notify_attempts}): {e}")
+                if attempt + 1 < notify_attempts:
+                    await asyncio.sleep(notify_backoff * 2 ** attempt)
+    notifications_sent.inc(result='failed')
+    return False
+
+
+""" Load all channel subscriptions into the scheduler before the
+    notification loop starts. An error here would stop the loop for
+    good, so loading is retried with backoff until the database is
+    reachable, and indexes are only created where possible."""
+
+
+@check_notifications.before_loop
+async def load_subscriptions():
+    try:
+        await subscriptions.ensure_indexes()
+    except pymongo.errors.PyMongoError as e:
+        print(f"Cannot create subscription indexes: {e}")
+
+    delay = notify_backoff
+    while True:
+        try:
+            rows = await subscriptions.load()
+            break
+        except pymongo.errors.PyMongoError as e:
+            print(traceback.format_exc())
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, notify_retry_delay.total_seconds())
+    scheduler.clear()
+    for row in rows:
+        scheduler.schedule(row['_id'], next_check_date(row))
+    print(f"Loaded {len(rows)} notification subscriptions")
+
+
+""" Apply subscription changes made by other bot instances to the
+    scheduler using a MongoDB change stream. Only started when the
+    WATCH_SUBSCRIPTIONS environment variable is set, as change streams
+    require a replica set."""
+
+
+async def watch_subscriptions():
+    while True:
+        try:
+            async with db_table.watch(full_document='updateLookup') as stream:
+                async for change in stream:
+                    channel_id = change['documentKey']['_id']
+                    doc = change.get('fullDocument')
+                    subscriptions.apply(channel_id, doc)
+                    if change['operationType'] == 'delete' or doc is None:
+                        scheduler.cancel(channel_id)
+                    else:
+                        scheduler.schedule(channel_id, next_check_date(doc))
+        except Exception as e:
+            print(traceback.format_exc())
+            await asyncio.sleep(notify_retry_delay.total_seconds())
+
+
+if __name__ == '__main__':
+    client.run(os.getenv('RELEASES_TOKEN'))
@@ -0,0 +1,391 @@
+""" Load test of the bot's commands and daily notifications against
+stand-ins for Discord, Wikipedia and MongoDB. Discord is replaced by a
+fake transport with simulated send latency, Wikipedia by the saved
+article fixtures used by benchmark.py, and MongoDB by mongomock or a
+local mongod.
+
+    python loadtest.py                           Run with default load
+    python loadtest.py --commands 5000 --concurrency 500
+                                                 Drive more commands at once
+    python loadtest.py --subscriptions 10000 --notify-rate 200
+                                                 Deliver more notifications,
+                                                 faster than the default limit
+    python loadtest.py --mongo mongodb://localhost:27017
+                                                 Use a local mongod instead
+                                                 of mongomock """
+
+import argparse
+import asyncio
+import datetime
+import hashlib
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+import discord
+from aiohttp import web
+from discord.ext import commands
+from discord.ext.commands.view import StringView
+
+from benchmark import fixture_path
+from releases import month_names
+
+
+""" Asynchronous wrapper around a mongomock collection, standing in for a
+    Motor collection """
+
+
+class MockCollection:
+
+    def __init__(self):
+        import mongomock
+        self.collection = mongomock.MongoClient().loadtest.subscriptions
+
+    def find(self, *args, **kwargs):
+        return MockCursor(self.collection.find(*args, **kwargs))
+
+    def __getattr__(self, name):
+        method = getattr(self.collection, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+
+class MockCursor:
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    async def to_list(self, length=None):
+        return list(self.cursor)
+
+
+""" Discord stand-in that records messages sent to channels after a
+    simulated REST round trip """
+
+
+class FakeDiscord:
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.channels = {}
+        self.sent = []
+
+    def channel(self, channel_id):
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            channel = self.channels[channel_id] = FakeChannel(self, channel_id)
+        return channel
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    async def fetch_channel(self, channel_id):
+        await asyncio.sleep(self.latency)
+        return self.channel(channel_id)
+
+    async def send(self, channel_id, content=None, embed=None):
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        title = embed.title if embed is not None else content
+        self.sent.append((channel_id, title, datetime.datetime.utcnow()))
+        return FakeMessage(self, len(self.sent))
+
+    async def request(self):
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+
+class FakeChannel:
+
+    def __init__(self, transport, channel_id):
+        self.transport = transport
+        self.id = channel_id
+        self.guild = types.SimpleNamespace(id=channel_id, text_channels=[self],
+                                           me=types.SimpleNamespace(id=0))
+
+    def permissions_for(self, member):
+        return discord.Permissions.all()
+
+    async def send(self, content=None, *, embed=None, **kwargs):
+        return await self.transport.send(self.id, content, embed)
+
+    def __str__(self):
+        return f"channel-{self.id}"
+
+
+class FakeMessage:
+
+    def __init__(self, transport, message_id):
+        self.transport = transport
+        self.id = message_id
+
+    async def add_reaction(self, emoji):
+        await self.transport.request()
+
+    async def edit(self, **kwargs):
+        await self.transport.request()
+
+
+class FakeContext(commands.Context):
+
+    async def send(self, content=None, *, embed=None, **kwargs):
+        return await self.channel.send(content, embed=embed)
+
+
+author = types.SimpleNamespace(id=1, bot=False, name="loadtest")
+timezones = [None, 'America/Los_Angeles', 'Europe/Berlin', 'Asia/Tokyo',
+             'Australia/Sydney', 'Pacific/Kiritimati']
+
+
+""" Serve saved article fixtures in place of Wikipedia, answering
+    conditional requests like the real site """
+
+
+async def start_wiki(port, latency):
+    async def article(request):
+        path = fixture_path(request.match_info['year'])
+        if not os.path.exists(path):
+            raise web.HTTPNotFound()
+        with open(path, encoding='utf-8') as f:
+            html = f.read()
+        etag = '"{0}"'.format(hashlib.md5(html.encode()).hexdigest())
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304)
+        await asyncio.sleep(latency)
+        return web.Response(text=html, content_type='text/html',
+                            headers={'ETag': etag})
+
+    app = web.Application()
+    app.router.add_get('/wiki/{year}_in_video_games', article)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+
+""" Import the bot with its database settings, without connecting to
+    Discord """
+
+
+def load_bot(args):
+    os.environ.setdefault('DATABASE', 'loadtest')
+    os.environ.setdefault('TABLE', 'subscriptions')
+    if args.mongo:
+        os.environ['CLUSTER'] = args.mongo
+    import bot
+    if not args.mongo:
+        bot.db_table = bot.subscriptions.collection = MockCollection()
+    return bot
+
+
+""" Record how late the event loop wakes up from short sleeps """
+
+
+async def monitor_lag(samples, interval=0.05):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - start - interval)
+
+
+""" Invoke a command the way the bot does for a received message.
+    Returns the time taken """
+
+
+async def run_command(bot, transport, channel_id, content):
+    channel = transport.channel(channel_id)
+    message = types.SimpleNamespace(content=content, channel=channel,
+                                    guild=channel.guild, author=author,
+                                    created_at=datetime.datetime.utcnow(),
+                                    _state=None)
+    view = StringView(content)
+    ctx = FakeContext(prefix=bot.prefix, view=view, bot=bot.client,
+                      message=message)
+    view.skip_string(bot.prefix)
+    ctx.invoked_with = view.get_word()
+    ctx.command = bot.client.all_commands.get(ctx.invoked_with)
+
+    start = time.perf_counter()
+    await bot.client.invoke(ctx)
+    return time.perf_counter() - start
+
+
+def random_command(rng, prefix, year):
+    name = rng.choices(['list', 'new', 'soon', 'notify', 'set', 'stop', 'changes'],
+                       weights=[3, 2, 2, 1, 1, 1, 1])[0]
+    if name == 'list':
+        return f"{prefix}list {rng.choice(month_names)} {year}"
+    if name in ('notify', 'set'):
+        return f"{prefix}{name} {rng.randrange(24):02}{rng.randrange(60):02}"
+    return prefix + name
+
+
+""" Run commands from many channels with a fixed number in flight.
+    Returns latencies and elapsed time """
+
+
+async def command_phase(bot, transport, args):
+    rng = random.Random(args.seed)
+    year = datetime.datetime.utcnow().year
+    slots = asyncio.Semaphore(args.concurrency)
+    latencies = []
+
+    async def one(i):
+        async with slots:
+            content = random_command(rng, bot.prefix, year)
+            latencies.append(await run_command(bot, transport,
+                                               1 + i % args.guilds, content))
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(args.commands)])
+    return latencies, time.perf_counter() - start
+
+
+""" Subscribe channels with notifications falling due over the spread
+    and run the notification loop until all are delivered. Returns lag
+    behind each due date and elapsed time from the first due date """
+
+
+async def notification_phase(bot, transport, args):
+    base = 10 ** 6
+    first_due = (datetime.datetime.utcnow()
+                 + datetime.timedelta(seconds=2)).replace(microsecond=0)
+    zones = timezones[:max(args.timezones, 1)]
+    due = {}
+    rows = []
+    for i in range(args.subscriptions):
+        channel_id = base + i
+        transport.channel(channel_id)
+        # Due dates are aligned to slots like the notify dates the bot
+        # stores
+        due[channel_id] = bot.scheduler.slot_date(first_due + datetime.timedelta(
+            seconds=i % max(args.spread, 1)))
+        row = {'_id': channel_id, 'notify_date': due[channel_id]}
+        if zones[i % len(zones)] is not None:
+            row['timezone'] = zones[i % len(zones)]
+        rows.append(row)
+    if rows:
+        await bot.subscriptions.collection.insert_many(rows)
+
+    # Subscriptions are loaded into the scheduler as the loop starts
+    bot.check_notifications.start()
+    last_due = max(due.values(), default=first_due)
+    deadline = (time.monotonic() + args.timeout
+                + (last_due - datetime.datetime.utcnow()).total_seconds())
+    delivered = {}
+    while len(delivered) < len(due) and time.monotonic() < deadline:
+        await asyncio.sleep(0.25)
+        for channel_id, title, sent in transport.sent:
+            if channel_id in due and title == "Today's Releases":
+                delivered.setdefault(channel_id, sent)
+    bot.check_notifications.cancel()
+
+    lags = [(sent - due[channel_id]).total_seconds()
+            for channel_id, sent in delivered.items()]
+    elapsed = ((max(delivered.values()) - min(due.values())).total_seconds()
+               if delivered else 0.0)
+    return lags, elapsed, len(due) - len(delivered)
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def report(name, count, elapsed, values, failed=0):
+    print(f"{name:<14}{count:>8}{count / max(elapsed, 1e-9):>10.1f}"
+          f"{percentile(values, 0.5) * 1000:>10.1f}"
+          f"{percentile(values, 0.99) * 1000:>10.1f}"
+          f"{max(values, default=float('nan')) * 1000:>10.1f}{failed:>8}")
+
+
+async def main(bot, args):
+    wiki = await start_wiki(args.wiki_port, args.wiki_latency / 1000)
+    transport = FakeDiscord(args.send_latency / 1000)
+    bot.table_url = f"http://127.0.0.1:{args.wiki_port}/wiki/{{0}}_in_video_games"
+    bot.client.get_channel = transport.get_channel
+    bot.client.fetch_channel = transport.fetch_channel
+    if args.slot is not None:
+        bot.scheduler.slot = datetime.timedelta(seconds=args.slot)
+    if args.notify_rate:
+        bot.send_limiter = bot.RateLimiter(args.notify_rate)
+    if args.mongo:
+        await bot.db_table.drop()
+
+    if not args.cold:
+        year = datetime.datetime.utcnow().year
+        for y in (year, year + 1):
+            try:
+                await bot.get_year_data(y)
+            except Exception as e:
+                print(f"No release data for {y}: {e}")
+
+    lag = []
+    monitor = asyncio.ensure_future(monitor_lag(lag))
+    try:
+        command_latencies, command_time = await command_phase(bot, transport, args)
+        command_lag = list(lag)
+        lags, notify_time, missed = await notification_phase(bot, transport, args)
+    finally:
+        monitor.cancel()
+        await wiki.cleanup()
+        if bot.year_cache.session is not None:
+            await bot.year_cache.session.close()
+        if args.mongo:
+            await bot.db_table.drop()
+
+    print()
+    print(f"{'Phase':<14}{'Count':>8}{'Per sec':>10}{'p50 ms':>10}"
+          f"{'p99 ms':>10}{'Max ms':>10}{'Failed':>8}")
+    report('commands', len(command_latencies), command_time, command_latencies)
+    report('notify lag', len(lags), notify_time, lags, missed)
+    print(f"\nEvent loop lag: p50 {percentile(lag, 0.5) * 1000:.1f} ms, "
+          f"p99 {percentile(lag, 0.99) * 1000:.1f} ms, "
+          f"max {max(lag, default=0) * 1000:.1f} ms "
+          f"(p99 {percentile(command_lag, 0.99) * 1000:.1f} ms during commands)")
+    return missed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--commands', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--guilds', type=int, default=500,
+                        help="Channels the commands are spread over")
+    parser.add_argument('--subscriptions', type=int, default=1000)
+    parser.add_argument('--spread', type=int, default=10,
+                        help="Seconds over which notifications fall due")
+    parser.add_argument('--slot', type=float,
+                        help="Seconds of due dates sent together as one batch, "
+                             "instead of the bot's notify_slot")
+    parser.add_argument('--timezones', type=int, default=1,
+                        help=f"Timezones the subscriptions are spread over, up to {len(timezones)}")
+    parser.add_argument('--timeout', type=int, default=120,
+                        help="Seconds to wait for notifications after the last is due")
+    parser.add_argument('--notify-rate', type=float,
+                        help="Notifications sent per second, instead of the bot's limit")
+    parser.add_argument('--send-latency', type=float, default=50,
+                        help="Simulated Discord round trip in milliseconds")
+    parser.add_argument('--wiki-latency', type=float, default=200,
+                        help="Simulated Wikipedia response time in milliseconds")
+    parser.add_argument('--wiki-port', type=int, default=8766)
+    parser.add_argument('--mongo', metavar='URL',
+                        help="Use the MongoDB server at URL instead of mongomock")
+    parser.add_argument('--cold', action='store_true',
+                        help="Start without release data cached")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    bot = load_bot(args)
+    store_dir = bot.store_dir = tempfile.mkdtemp()
+    try:
+        missed = bot.client.loop.run_until_complete(main(bot, args))
+    finally:
+        shutil.rmtree(store_dir, ignore_errors=True)
+    sys.exit(1 if missed else 0)
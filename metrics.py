@@ -0,0 +1,171 @@
+import cProfile
+import io
+import pstats
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+registry = []
+
+
+""" Minimal metrics in the Prometheus text format, served over a local
+    HTTP endpoint. Each metric can carry labels given as keyword
+    arguments when it is updated."""
+
+
+class Metric:
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, callback=None):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.values = {}
+        registry.append(self)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for labels, value in sorted(self.samples()):
+            yield f"{self.name}{format_labels(labels)} {value}"
+
+    def samples(self):
+        # Metrics with a callback are read when scraped. The callback
+        # returns a value, or a dict of label tuples to values
+        if self.callback is None:
+            return self.values.items()
+        value = self.callback()
+        if isinstance(value, dict):
+            return value.items()
+        return [((), value)]
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=default_buckets):
+        super().__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        counts = self.values.get(key)
+        if counts is None:
+            counts = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[0][i] += 1
+        counts[1] += 1
+        counts[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for labels, (buckets, count, total) in sorted(self.values.items()):
+            for bound, bucket in zip(self.buckets, buckets):
+                le = labels + (('le', bound),)
+                yield f"{self.name}_bucket{format_labels(le)} {bucket}"
+            le = labels + (('le', '+Inf'),)
+            yield f"{self.name}_bucket{format_labels(le)} {count}"
+            yield f"{self.name}_count{format_labels(labels)} {count}"
+            yield f"{self.name}_sum{format_labels(labels)} {total}"
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join('{0}="{1}"'.format(
+        k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in labels)
+    return '{' + pairs + '}'
+
+
+def render():
+    lines = [line for metric in registry for line in metric.render()]
+    return '\n'.join(lines) + '\n'
+
+
+""" Profiling of the event loop thread that can be switched on and off
+    while the bot runs. Stopping returns the most expensive calls """
+
+profiler = None
+
+
+def start_profiling():
+    global profiler
+    if profiler is None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return True
+    return False
+
+
+def stop_profiling(limit=40):
+    global profiler
+    if profiler is None:
+        return None
+    profiler.disable()
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(limit)
+    profiler = None
+    return out.getvalue()
+
+
+async def handle_metrics(request):
+    return web.Response(text=render(),
+                        content_type='text/plain', charset='utf-8')
+
+
+async def handle_profile(request):
+    action = request.match_info['action']
+    if action == 'start':
+        started = start_profiling()
+        return web.Response(text="Profiling started\n" if started
+                            else "Profiling already running\n")
+    report = stop_profiling(int(request.query.get('limit', 40)))
+    return web.Response(text=report or "Profiling not running\n")
+
+
+""" Serve /metrics, and /profile/start and /profile/stop for the
+    profiling hook, on a local port """
+
+
+async def start_server(port, host='127.0.0.1'):
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/profile/{action:start|stop}', handle_profile)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,560 @@
+import datetime
+import io
+import json
+import os
+import re
+import numpy as np
+from lxml import etree
+
+
+first_year = 2015  # Earliest year with release tables in the expected format
+headings = ['Month', 'Day', 'Title']
+# Extra columns kept for filtering, found by the start of their heading
+column_headings = {'platforms': 'Platform', 'genres': 'Genre',
+                   'developers': 'Developer'}
+table_width = 8  # Columns read from release tables
+month_names = ["January", "February", "March",
+               "April", "May", "June",
+               "July", "August", "September",
+               "October", "November", "December"]
+month_numbers = {name.upper(): i for i, name in enumerate(month_names, 1)}
+store_version = 3
+whitespace_pattern = re.compile(r"[\r\n]+|\s{2,}")
+footnote_pattern = re.compile(r"\[.*\]")
+# Wikipedia platform abbreviations for names users are likely to type
+platform_aliases = {'switch': 'ns', 'nintendo switch': 'ns',
+                    'pc': 'win', 'windows': 'win', 'linux': 'lin',
+                    'macos': 'mac', 'android': 'droid',
+                    'playstation 4': 'ps4', 'playstation 5': 'ps5',
+                    'xbox one': 'xbo', 'xbox series': 'xsx/s',
+                    'xbox series x': 'xsx/s', 'xsx': 'xsx/s'}
+
+
+""" Parses wikipedia tables from article HTML for chosen year and filters
+for tables for releases. Returns releases sorted by date"""
+
+
+def parse_year_data(html, year):
+    return Releases.from_rows(
+        year, (row for table in release_tables(html) for row in table))
+
+
+""" Parses release tables using pd.read_html. Slower than parse_year_data
+and kept as the reference its output is checked against, so pandas is
+only imported when it is used"""
+
+
+def read_html_year_data(html, year):
+    import pandas as pd
+    tables = pd.read_html(io.StringIO(html), match='Title')
+
+    # Keep tables with first 3 columns of release tables as expected
+    rows = []
+    for frame in tables:
+        if list(frame.columns[:3]) == headings:
+            positions = column_positions(list(frame.columns))
+            frame = frame.fillna('').astype(str)
+            rows.extend(
+                row[:3] + tuple(row[i] if i is not None else None
+                                for i in positions)
+                for row in frame.itertuples(index=False, name=None))
+    return Releases.from_rows(year, rows)
+
+
+""" Streams article HTML and yields the Month, Day and Title cells of
+each row of tables whose header row starts with Month/Day/Title,
+followed by its platforms, genres and developers cells, or None where
+the table has no such column. Other tables are discarded as soon as they
+have been read, and cells merged over several rows or columns are
+repeated in each of them"""
+
+
+def release_tables(html):
+    if isinstance(html, str):
+        html = html.encode('utf-8')
+    events = etree.iterparse(io.BytesIO(html), events=('end',), tag='table',
+                             html=True, encoding='utf-8')
+    for _, table in events:
+        rows = table_rows(table, table_width)
+        header = next(rows, None)
+        if header is not None and header[:3] == headings:
+            positions = column_positions(header)
+            yield [tuple(row[:3]) + tuple(row[i] if i is not None and i < len(row)
+                                          else None for i in positions)
+                   for row in rows if len(row) >= 3]
+
+        # Free parsed elements that are no longer needed, leaving tables
+        # nested in other tables for the outer table to read
+        if next(table.iterancestors('table'), None) is None:
+            table.clear()
+            while table.getprevious() is not None:
+                del table.getparent()[0]
+
+
+def column_positions(header):
+    # Position of each extra column in a table's header, None if missing
+    positions = []
+    for heading in column_headings.values():
+        positions.append(next((i for i, cell in enumerate(header)
+                               if isinstance(cell, str) and cell.startswith(heading)),
+                              None))
+    return positions
+
+
+""" Yields text of cells in each row of a table, with rowspan and colspan
+cells placed in every row and column they cover. Only the text of the
+first width columns is read """
+
+
+def table_rows(table, width):
+    spans = {}
+    for tr in table.iter('tr'):
+        # Skip rows of tables nested inside this one
+        if next(tr.iterancestors('table')) is not table:
+            continue
+        row = []
+        col = 0
+        for cell in tr:
+            if cell.tag not in ('td', 'th') or is_hidden(cell):
+                continue
+            col = fill_spans(row, spans, col)
+            text = cell_text(cell) if col < width else None
+            rowspan = span(cell, 'rowspan')
+            for i in range(span(cell, 'colspan')):
+                row.append(text)
+                if rowspan > 1:
+                    spans[col] = [rowspan - 1, text]
+                col += 1
+        fill_spans(row, spans, col, end=True)
+        yield row
+
+
+def fill_spans(row, spans, col, end=False):
+    # Place cells merged from rows above at col, or at all remaining
+    # columns if end of row
+    while col in spans or (end and any(c >= col for c in spans)):
+        if col in spans:
+            remaining, text = spans[col]
+            row.append(text)
+            if remaining > 1:
+                spans[col][0] -= 1
+            else:
+                del spans[col]
+        col += 1
+    return col
+
+
+def span(cell, attr):
+    try:
+        return max(1, int(cell.get(attr, 1)))
+    except ValueError:
+        return 1
+
+
+def is_hidden(elem):
+    return 'display:none' in elem.get('style', '').replace(' ', '')
+
+
+def cell_text(cell):
+    # Collapse whitespace as pd.read_html does
+    return whitespace_pattern.sub(' ', element_text(cell).strip())
+
+
+def element_text(elem):
+    # Text of element and its children, leaving out hidden elements and
+    # comments
+    parts = [elem.text or '']
+    for child in elem:
+        if isinstance(child.tag, str) and not is_hidden(child):
+            parts.append(element_text(child))
+        parts.append(child.tail or '')
+    return ''.join(parts)
+
+
+""" Compact store of releases sorted by date. Release days are kept in a
+datetime64[D] array and titles are packed into one UTF-8 buffer indexed
+by offsets, rather than as one Python string per release. Extra columns
+such as platforms are stored as small-int category codes. Slicing
+returns a view sharing the same buffers, so no releases are copied"""
+
+
+class Releases:
+
+    def __init__(self, dates, title_data, title_offsets, columns=None):
+        self.dates = dates
+        self.title_data = title_data
+        self.title_offsets = title_offsets
+        self.columns = columns or {}
+
+    """ Build store for a year from Month, Day and Title cell text,
+    optionally followed by platforms, genres and developers cell text.
+    Rows with TBA or otherwise invalid dates are dropped """
+
+    @classmethod
+    def from_rows(cls, year, rows):
+        year = int(year)
+        dates = []
+        titles = []
+        values = {name: [] for name in column_headings}
+        for month, day, title, *extra in rows:
+            month = month_numbers.get(month.strip().upper())
+            title = footnote_pattern.sub('', title) if title else ''
+            try:
+                date = datetime.date(year, month, int(float(day)))
+            except (TypeError, ValueError, OverflowError):
+                continue
+            if not title:
+                continue
+            dates.append(date)
+            titles.append(title)
+            for name, value in zip(column_headings, extra + [None] * 3):
+                values[name].append(footnote_pattern.sub('', value).strip()
+                                    if value else '')
+
+        dates = np.array(dates, dtype='datetime64[D]')
+        order = np.argsort(dates, kind='stable')
+        return cls.from_titles(dates[order], [titles[i] for i in order],
+                               {name: categorize([column[i] for i in order])
+                                for name, column in values.items()})
+
+    @classmethod
+    def from_titles(cls, dates, titles, columns=None):
+        encoded = [title.encode('utf-8') for title in titles]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(title) for title in encoded], out=offsets[1:])
+        return cls(dates, b''.join(encoded), offsets, columns)
+
+    @classmethod
+    def empty(cls):
+        return cls.from_titles(np.array([], dtype='datetime64[D]'), [])
+
+    """ Join stores into one, in the order given """
+
+    @classmethod
+    def concat(cls, stores):
+        if not stores:
+            return cls.empty()
+        offsets = [stores[0].title_offsets[:1] - stores[0].title_offsets[0]]
+        base = 0
+        for store in stores:
+            offsets.append(store.title_offsets[1:] - store.title_offsets[0] + base)
+            base += store.title_offsets[-1] - store.title_offsets[0]
+        columns = {}
+        for name in set().union(*(store.columns for store in stores)):
+            columns[name] = concat_column([store.column(name) for store in stores])
+        return cls(np.concatenate([store.dates for store in stores]),
+                   b''.join(store.packed_titles() for store in stores),
+                   np.concatenate(offsets), columns)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError("Releases only support contiguous slices")
+        start, stop, step = key.indices(len(self))
+        stop = max(start, stop)
+        return Releases(self.dates[start:stop], self.title_data,
+                        self.title_offsets[start:stop + 1],
+                        {name: (codes[start:stop], labels)
+                         for name, (codes, labels) in self.columns.items()})
+
+    def __iter__(self):
+        return zip(self.dates.astype(object), self.titles())
+
+    def titles(self):
+        offsets = self.title_offsets.tolist()
+        data = self.title_data
+        return [data[offsets[i]:offsets[i + 1]].decode('utf-8')
+                for i in range(len(offsets) - 1)]
+
+    def take(self, rows):
+        # Copy of the releases at positions rows, for selections that are
+        # not contiguous
+        starts = self.title_offsets[rows]
+        ends = self.title_offsets[rows + 1]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(ends - starts, out=offsets[1:])
+        data = self.title_data
+        return Releases(self.dates[rows],
+                        b''.join(data[a:b] for a, b in zip(starts.tolist(),
+                                                           ends.tolist())),
+                        offsets,
+                        {name: (codes[rows], labels)
+                         for name, (codes, labels) in self.columns.items()})
+
+    def packed_titles(self):
+        return self.title_data[self.title_offsets[0]:self.title_offsets[-1]]
+
+    def column(self, name):
+        # Category codes and labels for column, all 0 (unknown) if missing
+        if name in self.columns:
+            return self.columns[name]
+        return np.zeros(len(self), dtype=np.uint8), ['']
+
+    @property
+    def nbytes(self):
+        return (self.dates.nbytes + len(self.packed_titles())
+                + self.title_offsets.nbytes
+                + sum(codes.nbytes for codes, labels in self.columns.values()))
+
+
+def categorize(values):
+    # Category codes for values, with code 0 for unknown ('')
+    lookup = {'': 0}
+    codes = [lookup.setdefault(value, len(lookup)) for value in values]
+    return (np.array(codes, dtype=code_dtype(len(lookup))),
+            sorted(lookup, key=lookup.get))
+
+
+def code_dtype(labels):
+    return (np.uint8 if labels <= 1 << 8 else
+            np.uint16 if labels <= 1 << 16 else np.uint32)
+
+
+def concat_column(parts):
+    # Merge category labels and remap each part's codes onto them
+    lookup = {}
+    remapped = []
+    for codes, part_labels in parts:
+        mapping = np.array([lookup.setdefault(label, len(lookup))
+                            for label in part_labels], dtype=np.int64)
+        remapped.append(mapping[codes])
+    labels = sorted(lookup, key=lookup.get)
+    return np.concatenate(remapped).astype(code_dtype(len(labels))), labels
+
+
+""" Saves parsed releases for a year to a numpy archive, along with
+metadata such as the article revision. The file is written to a
+temporary path first so readers never see a partial file"""
+
+
+def save_year_data(path, releases, meta):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    meta = dict(meta, version=store_version,
+                columns={name: labels
+                         for name, (codes, labels) in releases.columns.items()})
+    arrays = {f"column_{name}": codes
+              for name, (codes, labels) in releases.columns.items()}
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f,
+                 date=releases.dates,
+                 title_data=np.frombuffer(releases.packed_titles(), dtype=np.uint8),
+                 title_offsets=releases.title_offsets - releases.title_offsets[0],
+                 meta=np.array(json.dumps(meta)),
+                 **arrays)
+    os.replace(tmp_path, path)
+
+
+""" Loads releases and metadata saved by save_year_data. Raises
+ValueError for files written in an older format"""
+
+
+def load_year_data(path):
+    with np.load(path) as data:
+        meta = json.loads(str(data['meta']))
+        if meta.pop('version', None) != store_version:
+            raise ValueError(f"{path} has an unsupported store version")
+        columns = {name: (data[f"column_{name}"], labels)
+                   for name, labels in meta.pop('columns').items()}
+        releases = Releases(data['date'], data['title_data'].tobytes(),
+                            data['title_offsets'], columns)
+    return releases, meta
+
+
+""" Index of releases across all loaded years, backed by each year's
+sorted store. The stores are the ones the year cache holds, so no
+release is kept twice and replacing a year touches nothing else. Date
+lookups are binary searches returning views of a year's store, so they
+cost O(log n + k). Windows spanning two years join their two slices,
+which only copies the releases in the window.
+Lookups can be filtered by platform, genre or developer. Each filter
+term has a bitset over each year's store, and filtering a date range is
+a bitwise combination of bitsets followed by a slice"""
+
+
+class ReleaseIndex:
+
+    def __init__(self):
+        self.years = {}
+        self.versions = {}
+        self.next_version = 1
+        self.bitsets = {}
+
+    def set_year(self, year, releases):
+        # Versions change whenever a year's data does, so anything derived
+        # from the index can tell when it is out of date
+        self.years[int(year)] = releases
+        self.versions[int(year)] = self.next_version
+        self.next_version += 1
+        self.drop_bitsets(int(year))
+
+    def drop_year(self, year):
+        if self.years.pop(int(year), None) is not None:
+            del self.versions[int(year)]
+            self.drop_bitsets(int(year))
+
+    def drop_bitsets(self, year):
+        self.bitsets = {key: bits for key, bits in self.bitsets.items()
+                        if key[0] != year}
+
+    @property
+    def nbytes(self):
+        return sum(r.nbytes for r in self.years.values())
+
+    """ Bitset of a year's releases whose column has a value matching
+    term, packed 8 releases to a byte. It is built from the column's
+    category labels in one pass over the releases and kept until the
+    year changes """
+
+    def bitset(self, year, column, term):
+        bits = self.bitsets.get((year, column, term))
+        if bits is None:
+            codes, labels = self.years[year].column(column)
+            matches = np.array([label_matches(column, label, term)
+                                for label in labels], dtype=bool)
+            bits = np.packbits(matches[codes])
+            # Only terms that match are kept, so arbitrary input cannot
+            # grow the cache
+            if bits.any():
+                self.bitsets[(year, column, term)] = bits
+        return bits
+
+    """ Column a normalized filter term matches values of, or None if it
+    matches no platform, genre or developer """
+
+    def filter_column(self, term):
+        for column in column_headings:
+            if any(self.bitset(year, column, term).any() for year in self.years):
+                return column
+        return None
+
+    """ Bitset of a year's releases matching all filter terms, given with
+    the column each matches. Terms for the same column are alternatives,
+    so 'ns ps5' matches releases on either, and terms for different
+    columns must all match """
+
+    def filter_bits(self, year, terms):
+        combined = {}
+        for column, term in terms:
+            bits = self.bitset(year, column, term)
+            combined[column] = (combined[column] | bits if column in combined
+                                else bits)
+        result = None
+        for bits in combined.values():
+            result = bits if result is None else result & bits
+        return result
+
+    """ Get releases between start and end dates. inclusive is one of
+    'both', 'left', 'right' or 'neither' as in pandas Series.between.
+    Returns a view of a year's releases, or a copy if the dates span
+    years or filters are given. Terms that match nothing match no
+    releases"""
+
+    def between(self, start, end, inclusive='both', filters=()):
+        start = np.datetime64(start, 'D')
+        end = np.datetime64(end, 'D')
+        terms = [(self.filter_column(term), term) for term in filters]
+        if any(column is None for column, term in terms):
+            return Releases.empty()
+
+        parts = []
+        for year in range(start.astype('datetime64[Y]').astype(int) + 1970,
+                          end.astype('datetime64[Y]').astype(int) + 1971):
+            releases = self.years.get(year)
+            if releases is None:
+                continue
+            first = np.searchsorted(
+                releases.dates, start,
+                side='left' if inclusive in ('both', 'left') else 'right')
+            last = np.searchsorted(
+                releases.dates, end,
+                side='right' if inclusive in ('both', 'right') else 'left')
+            if first >= last:
+                continue
+            part = releases[first:last]
+            if terms:
+                bits = self.filter_bits(year, terms)
+                offset = first % 8
+                mask = np.unpackbits(bits[first // 8:(last + 7) // 8])
+                part = part.take(
+                    np.flatnonzero(mask[offset:offset + last - first]))
+            parts.append(part)
+        if len(parts) == 1:
+            return parts[0]
+        return Releases.concat(parts)
+
+    def day(self, date, filters=()):
+        return self.between(date, date, filters=filters)
+
+    def week(self, start, filters=()):
+        start = np.datetime64(start, 'D')
+        return self.between(start, start + np.timedelta64(7, 'D'), 'left',
+                            filters)
+
+    def month(self, year, month, filters=()):
+        start = np.datetime64(f"{int(year):04d}-{int(month):02d}", 'M')
+        return self.between(start, start + np.timedelta64(1, 'M'), 'left',
+                            filters)
+
+
+""" Normalize filter terms typed by users, mapping common platform names
+to Wikipedia's abbreviations. Returns the distinct terms in sorted order,
+so the same filters always give the same cache keys"""
+
+
+def normalize_filters(filters):
+    terms = {' '.join(term.casefold().split()) for term in filters}
+    return tuple(sorted({platform_aliases.get(term, term)
+                         for term in terms if term}))
+
+
+def label_matches(column, label, term):
+    # Labels hold a cell's comma separated values. Developers match on
+    # part of a name, other columns on whole values
+    values = [value.strip().casefold() for value in label.split(',')]
+    if column == 'developers':
+        return any(term in value for value in values)
+    return term in values
+
+
+""" Compares two snapshots of a year's releases by title. Returns a change
+set mapping each added, removed or re-dated title to its old and new
+release dates, with None for a side the title is missing from. Titles
+with the same dates in both snapshots are left out"""
+
+
+def diff_releases(old, new):
+    old_dates = title_dates(old)
+    new_dates = title_dates(new)
+    changes = {}
+    for title in old_dates.keys() | new_dates.keys():
+        before = old_dates.get(title)
+        after = new_dates.get(title)
+        if before != after:
+            changes[title] = (before, after)
+    return changes
+
+
+def title_dates(releases):
+    # Titles can be listed more than once, e.g. for different regions
+    dates = {}
+    for date, title in releases:
+        dates.setdefault(title, []).append(date)
+    return {title: tuple(d) for title, d in dates.items()}
+
+
+""" Combines change sets in the order they were detected into one change
+set from the first snapshot to the last """
+
+
+def merge_changes(change_sets):
+    merged = {}
+    for changes in change_sets:
+        for title, (before, after) in changes.items():
+            if title in merged:
+                before = merged[title][0]
+            merged[title] = (before, after)
+    return {title: (before, after) for title, (before, after) in merged.items()
+            if before != after}
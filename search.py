@@ -0,0 +1,146 @@
+import re
+import unicodedata
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+import numpy as np
+
+
+token_pattern = re.compile(r'\w+')
+max_expansions = 50  # Index words a query word can match
+prefix_weight = 0.8
+fuzzy_weight = 0.6
+fuzzy_threshold = 0.5  # Share of trigrams a misspelt word must have in common
+fuzzy_min_length = 3
+
+
+""" Split text into lowercase words with accents removed """
+
+
+def tokenize(text):
+    text = unicodedata.normalize('NFKD', text.casefold())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return token_pattern.findall(text)
+
+
+def trigrams(word):
+    padded = f" {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+""" Inverted index of words in release titles across years, updated a
+    year at a time like the ReleaseIndex. Each word maps to the rows of
+    each year's releases whose titles contain it, and a trigram index
+    over the words finds close misspellings. A query word matches index
+    words that equal it or start with it, or if there are none, words
+    that look like it."""
+
+
+class TitleIndex:
+
+    def __init__(self):
+        self.years = {}
+        self.year_words = {}
+        self.postings = {}
+        self.grams = defaultdict(set)
+        self.vocabulary = None
+
+    def set_year(self, year, releases):
+        year = int(year)
+        self.drop_year(year)
+        rows = defaultdict(list)
+        for row, title in enumerate(releases.titles()):
+            for word in set(tokenize(title)):
+                rows[word].append(row)
+
+        for word, word_rows in rows.items():
+            postings = self.postings.get(word)
+            if postings is None:
+                postings = self.postings[word] = {}
+                for gram in trigrams(word):
+                    self.grams[gram].add(word)
+                self.vocabulary = None
+            postings[year] = np.array(word_rows, dtype=np.int32)
+        self.years[year] = releases
+        self.year_words[year] = list(rows)
+
+    def drop_year(self, year):
+        year = int(year)
+        if self.years.pop(year, None) is None:
+            return
+        for word in self.year_words.pop(year):
+            postings = self.postings[word]
+            del postings[year]
+            if not postings:
+                del self.postings[word]
+                for gram in trigrams(word):
+                    self.grams[gram].discard(word)
+                    if not self.grams[gram]:
+                        del self.grams[gram]
+                self.vocabulary = None
+
+    """ Index words matching a query word, with a weight for how closely
+    each matches """
+
+    def expand(self, word):
+        matches = {}
+        if word in self.postings:
+            matches[word] = 1.0
+
+        # Sorted words are only rebuilt after words are added or removed
+        if self.vocabulary is None:
+            self.vocabulary = sorted(self.postings)
+        start = bisect_left(self.vocabulary, word)
+        for other in self.vocabulary[start:start + max_expansions]:
+            if not other.startswith(word):
+                break
+            matches.setdefault(other, prefix_weight)
+        if matches or len(word) < fuzzy_min_length:
+            return matches
+
+        grams = trigrams(word)
+        shared = Counter(other for gram in grams
+                         for other in self.grams.get(gram, ()))
+        for other, count in shared.items():
+            # Dice coefficient of the two words' trigrams. A padded word
+            # has as many trigrams as it has characters
+            similarity = 2 * count / (len(grams) + len(other))
+            if similarity >= fuzzy_threshold:
+                matches[other] = similarity * fuzzy_weight
+        best = sorted(matches.items(), key=lambda m: -m[1])[:max_expansions]
+        return dict(best)
+
+    """ Find releases whose titles best match query. Releases matching the
+    most query words come first, then closer matches and shorter titles.
+    Returns up to limit (date, title) pairs """
+
+    def search(self, query, limit):
+        scores = {}
+        for word in dict.fromkeys(tokenize(query)):
+            best = {}
+            for match, weight in self.expand(word).items():
+                for year, rows in self.postings[match].items():
+                    for row in rows.tolist():
+                        if best.get((year, row), 0) < weight:
+                            best[(year, row)] = weight
+            for key, weight in best.items():
+                score = scores.setdefault(key, [0, 0.0])
+                score[0] += 1
+                score[1] += weight
+        if not scores:
+            return []
+
+        most = max(matched for matched, weight in scores.values())
+        ranked = []
+        for (year, row), (matched, weight) in scores.items():
+            if matched == most:
+                offsets = self.years[year].title_offsets
+                ranked.append((-weight, int(offsets[row + 1] - offsets[row]),
+                               year, row))
+        ranked.sort()
+
+        results = []
+        for weight, length, year, row in ranked[:limit]:
+            date, title = next(iter(self.years[year][row:row + 1]))
+            results.append((date, title))
+        return results
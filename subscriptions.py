@@ -0,0 +1,212 @@
+import pymongo
+from pymongo import ReturnDocument
+
+
+subscription_fields = {'notify_date': 1, 'notify_time': 1, 'lease_until': 1,
+                       'changes': 1, 'filters': 1, 'timezone': 1}
+lease_fields = {'lease_owner': '', 'lease_token': '', 'lease_until': ''}
+
+
+""" Access to channel notification subscriptions stored in MongoDB.
+    Each operation is a single round trip, and subscriptions read or
+    written by this instance are kept in a write-through cache so lookups
+    for known channels need no query. Works with any asynchronous
+    collection, such as a Motor collection for a local mongod."""
+
+
+class SubscriptionRepository:
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.cache = {}
+
+    async def ensure_indexes(self):
+        # notify_date serves due range queries, lease_token reads back
+        # claimed subscriptions
+        await self.collection.create_index('notify_date')
+        await self.collection.create_index('lease_token', sparse=True)
+
+    async def load(self):
+        rows = await self.collection.find(
+            {}, subscription_fields).to_list(length=None)
+        self.cache = {row['_id']: row for row in rows}
+        return rows
+
+    async def get(self, channel_id):
+        row = self.cache.get(channel_id)
+        if row is None:
+            row = await self.collection.find_one({'_id': channel_id},
+                                                 subscription_fields)
+            if row is not None:
+                self.cache[channel_id] = row
+        return row
+
+    """ Subscribe channel unless it is already subscribed, with notify
+    dates shown in timezone if one is given. notify_time is the minute of
+    the day in that timezone notifications are sent at. Returns the
+    existing subscription, or None if a new one was created """
+
+    async def add(self, channel_id, notify_date, notify_time, timezone=None):
+        fields = {'notify_date': notify_date, 'notify_time': notify_time}
+        if timezone:
+            fields['timezone'] = timezone
+        row = await self.collection.find_one_and_update(
+            {'_id': channel_id},
+            {'$setOnInsert': fields},
+            projection=subscription_fields,
+            upsert=True,
+            return_document=ReturnDocument.BEFORE)
+        self.cache[channel_id] = (row if row is not None else
+                                  dict(fields, _id=channel_id))
+        return row
+
+    """ Unsubscribe channel. Returns the removed subscription, or None if
+    the channel was not subscribed """
+
+    async def remove(self, channel_id):
+        self.cache.pop(channel_id, None)
+        return await self.collection.find_one_and_delete({'_id': channel_id},
+                                                         projection=subscription_fields)
+
+    """ Change the notification date and minute of the day of a subscribed
+    channel. Returns the updated subscription, or None if the channel is
+    not subscribed """
+
+    async def set_date(self, channel_id, notify_date, notify_time):
+        row = await self.collection.find_one_and_update(
+            {'_id': channel_id},
+            {'$set': {'notify_date': notify_date, 'notify_time': notify_time}},
+            projection=subscription_fields,
+            return_document=ReturnDocument.AFTER)
+        self.apply(channel_id, row)
+        return row
+
+    """ Turn the daily digest of release changes on or off for a
+    subscribed channel. Returns the updated subscription, or None if the
+    channel is not subscribed """
+
+    async def set_changes(self, channel_id, enabled):
+        row = await self.collection.find_one_and_update(
+            {'_id': channel_id},
+            {'$set': {'changes': enabled}},
+            projection=subscription_fields,
+            return_document=ReturnDocument.AFTER)
+        self.apply(channel_id, row)
+        return row
+
+    """ Set the platform, genre and developer filters for a subscribed
+    channel's notifications, or clear them if filters is empty. Returns
+    the updated subscription, or None if the channel is not subscribed """
+
+    async def set_filters(self, channel_id, filters):
+        update = ({'$set': {'filters': list(filters)}} if filters
+                  else {'$unset': {'filters': ''}})
+        row = await self.collection.find_one_and_update(
+            {'_id': channel_id}, update,
+            projection=subscription_fields,
+            return_document=ReturnDocument.AFTER)
+        self.apply(channel_id, row)
+        return row
+
+    """ Timezone of any subscribed channel among channel_ids, such as the
+    channels of a server, or None if none of them has one """
+
+    async def find_timezone(self, channel_ids):
+        row = await self.collection.find_one(
+            {'_id': {'$in': channel_ids}, 'timezone': {'$exists': True}},
+            {'timezone': 1})
+        return row['timezone'] if row is not None else None
+
+    """ Set the timezone of every subscribed channel among channel_ids, or
+    go back to UTC if timezone is None. Notify dates are kept, so the
+    stored minute of the day is cleared to be found again in the new
+    timezone. Returns the updated subscriptions """
+
+    async def set_timezone(self, channel_ids, timezone):
+        update = ({'$set': {'timezone': timezone}} if timezone
+                  else {'$unset': {'timezone': ''}})
+        update.setdefault('$unset', {})['notify_time'] = ''
+        await self.collection.update_many({'_id': {'$in': channel_ids}}, update)
+        return await self.find(channel_ids)
+
+    """ Take leases on due subscriptions for owner. Returns the claimed
+    subscriptions """
+
+    async def claim(self, channel_ids, curr_date, owner, token, lease_until):
+        await self.collection.update_many(
+            {'_id': {'$in': channel_ids},
+             'notify_date': {'$lte': curr_date},
+             '$or': [{'lease_until': None},
+                     {'lease_until': {'$lte': curr_date}},
+                     {'lease_owner': owner}]},
+            {'$set': {'lease_owner': owner,
+                      'lease_token': token,
+                      'lease_until': lease_until}})
+        rows = await self.collection.find(
+            {'lease_token': token}, subscription_fields).to_list(length=None)
+        for row in rows:
+            self.cache[row['_id']] = row
+        return rows
+
+    async def find(self, channel_ids):
+        rows = await self.collection.find(
+            {'_id': {'$in': channel_ids}}, subscription_fields).to_list(length=None)
+        found = {row['_id']: row for row in rows}
+        for channel_id in channel_ids:
+            self.apply(channel_id, found.get(channel_id))
+        return rows
+
+    """ Set new notification dates for subscriptions claimed with token,
+    along with the minute of the day they are sent at, and release their
+    leases in one bulk write. due_dates gives the notify date each
+    channel was claimed at, and channels unsubscribed or given a new date
+    since then are left as they are. Returns the new dates of the
+    subscriptions that were rescheduled """
+
+    async def reschedule(self, token, due_dates, next_dates, notify_times):
+        unchanged = self.unchanged(due_dates)
+        next_dates = {channel_id: notify_date
+                      for channel_id, notify_date in next_dates.items()
+                      if channel_id in unchanged}
+        if not next_dates:
+            return next_dates
+        await self.collection.bulk_write(
+            [pymongo.UpdateOne({'_id': channel_id, 'lease_token': token,
+                                'notify_date': due_dates[channel_id]},
+                               {'$set': {'notify_date': notify_date,
+                                         'notify_time': notify_times[channel_id]},
+                                '$unset': lease_fields})
+             for channel_id, notify_date in next_dates.items()],
+            ordered=False)
+
+        # Channels can also change while the write is in flight
+        unchanged = self.unchanged(due_dates)
+        rescheduled = {}
+        for channel_id, notify_date in next_dates.items():
+            if channel_id in unchanged:
+                row = self.cache[channel_id]
+                row['notify_date'] = notify_date
+                row['notify_time'] = notify_times[channel_id]
+                row.pop('lease_until', None)
+                rescheduled[channel_id] = notify_date
+        return rescheduled
+
+    """ Channels among due_dates that are still subscribed with the notify
+    date given for them, as far as this instance knows """
+
+    def unchanged(self, due_dates):
+        unchanged = set()
+        for channel_id, due_date in due_dates.items():
+            row = self.cache.get(channel_id)
+            if row is not None and row['notify_date'] == due_date:
+                unchanged.add(channel_id)
+        return unchanged
+
+    """ Update the cache with a subscription changed elsewhere, or remove
+    it if row is None """
+
+    def apply(self, channel_id, row):
+        if row is None:
+            self.cache.pop(channel_id, None)
+        else:
+            self.cache[channel_id] = row